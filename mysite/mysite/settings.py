@@ -68,6 +68,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'socknet.context_processors.pending_friend_requests',
             ],
         },
     },
@@ -96,6 +97,67 @@ else :
 
 
 
+# Cache
+# https://docs.djangoproject.com/en/1.10/topics/cache/
+# Use a shared backend (memcached, database) when running more than one process,
+# otherwise invalidating a cached post only reaches the process that saved it.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# Seconds a serialized post is kept for the posts api, see socknet.utils.PostCache
+POST_CACHE_TIMEOUT = 60 * 10
+
+# Most author pairs a node can ask about in one request to /api/friends/check/
+FRIENDSHIPS_QUERY_MAX_PAIRS = 100
+
+# How often an author's friend digest (see socknet.friend_digest) says an author is a
+# friend when they aren't, and the seconds other nodes may cache it for.
+FRIEND_DIGEST_FALSE_POSITIVE_RATE = 0.01
+FRIEND_DIGEST_MAX_AGE = 60 * 5
+
+# Seconds a remote friend of a friend check is remembered, see socknet.utils.FOAFCache
+FOAF_CACHE_TIMEOUT = 60 * 5
+
+# Seconds a node's checked basic auth credentials are trusted without hashing
+# the password again, and how many are kept. See socknet.authentication
+NODE_AUTH_CACHE_TIMEOUT = 60 * 5
+NODE_AUTH_CACHE_SIZE = 256
+
+# Seconds to wait for a node to connect or send data, how many nodes are asked at
+# once, and how long a page waits for all of them before rendering what arrived.
+NODE_REQUEST_TIMEOUT = 5
+NODE_FETCH_WORKERS = 8
+NODE_FETCH_DEADLINE = 8
+# Times a GET to a node is retried when connecting fails or it answers 502/503/504
+NODE_REQUEST_RETRIES = 2
+# After this many failed requests in a row a node isn't called for NODE_CIRCUIT_COOLDOWN
+# seconds, then one request is let through to see if it is back.
+NODE_FAILURE_THRESHOLD = 3
+NODE_CIRCUIT_COOLDOWN = 60
+
+# Largest response body read from a node's post list, and how many posts are read from
+# it at most, following its next links. Pages read while rendering a view stop earlier.
+NODE_FEED_MAX_BYTES = 5 * 1024 * 1024
+NODE_FEED_MAX_POSTS = 1000
+NODE_FEED_VIEW_MAX_POSTS = 100
+
+# Seconds before a friendship (or friend request) with a foreign author is checked
+# again with their node by the reconcile_foreign_friends command.
+FOREIGN_FRIEND_CHECK_INTERVAL = 60 * 5
+
+# Per kind of node endpoint: (seconds a cached GET response is used without asking the
+# node, seconds it is still used after that while it is refreshed in the background,
+# largest body that is cached, larger ones are passed on without being stored). The post
+# lists are read as they arrive above that, keep it under NODE_FEED_MAX_BYTES for them.
+NODE_RESPONSE_CACHE = {
+    'author': (60, 60 * 10, 64 * 1024),
+    'author_posts': (30, 60 * 5, 1024 * 1024),
+    'post': (30, 60 * 10, 256 * 1024),
+}
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.8/topics/i18n/
 
@@ -126,6 +188,21 @@ MEDIA_URL = '/media/'
 #MEDIA_ROOT = os.path.abspath(os.path.join(BASE_DIR, 'static'))
 MEDIA_ROOT = os.path.abspath(os.path.join(BASE_DIR, 'static'))
 
+# Where uploaded image bytes are kept, see socknet.image_storage
+# The file system backend needs a persistent disk (not the Heroku dyno's).
+IMAGE_STORAGE_BACKEND = 'socknet.image_storage.FileSystemImageStorage'
+IMAGE_STORAGE_OPTIONS = {
+    'location': os.environ.get('IMAGE_STORAGE_ROOT', os.path.join(BASE_DIR, 'image_store')),
+}
+
+# Resized copies of uploaded images, served with ?size=<name> on /media/<id> and /api/images/<id>
+# name: (max width, max height)
+IMAGE_VARIANTS = {
+    'thumb': (200, 200),
+    'display': (1024, 1024),
+}
+IMAGE_VARIANT_QUALITY = 85
+
 # Tom Christie
 # http://www.django-rest-framework.org/#installation
 REST_FRAMEWORK = {
@@ -78,6 +78,28 @@ class AuthorAdmin(admin.ModelAdmin):
             return self.readonly_fields + ('user',)
         return self.readonly_fields
 
+class NodeAdmin(admin.ModelAdmin):
+    """
+    Admin page for nodes, shows how the node has been answering (see NodeClient).
+    """
+    list_display = ['name', 'url', 'available', 'consecutive_failures', 'latency_ms', 'last_success_on', 'last_failure_on', 'posts_synced_on']
+    ordering = ['name']
+    readonly_fields = ('available', 'consecutive_failures', 'latency_ms', 'last_success_on', 'last_failure_on', 'last_error',
+        'circuit_open_until', 'posts_synced_on', 'posts_sync_error')
+    actions = ['close_circuit']
+
+    def available(self, obj):
+        return obj.is_available()
+    available.boolean = True # Display as icon
+
+    def close_circuit(self, request, queryset):
+        """
+        Lets requests go to the selected nodes again without waiting for the cool-down.
+        """
+        rows_updated = queryset.update(circuit_open_until=None, consecutive_failures=0)
+        self.message_user(request, "%s node(s) will be called again." % rows_updated)
+    close_circuit.short_description = "Call Selected Nodes Again"
+
 class ConfigAdmin(admin.ModelAdmin):
     """
     A custom admin page for the AdminConfig model.
@@ -105,7 +127,7 @@ admin.site.unregister(User)
 admin.site.register(User, UserAdmin)
 
 # Models we want to be able to edit in admin
-admin.site.register(Node)
+admin.site.register(Node, NodeAdmin)
 admin.site.register(Post)
 admin.site.register(Author, AuthorAdmin)
 admin.site.register(Comment)
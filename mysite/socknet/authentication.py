@@ -0,0 +1,95 @@
+import hashlib
+import hmac
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from rest_framework.authentication import BasicAuthentication
+
+from socknet.models import Node
+
+class CredentialCache():
+    """
+    Remembers basic auth credentials that were successfully checked for a node account.
+    Entries are keyed on an HMAC of the credentials so the passwords themselves are never kept,
+    and they expire after NODE_AUTH_CACHE_TIMEOUT seconds.
+    The cache holds at most NODE_AUTH_CACHE_SIZE entries.
+    """
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def make_key(self, userid, password):
+        credentials = (userid + u":" + password).encode('utf-8')
+        return hmac.new(settings.SECRET_KEY.encode('utf-8'), credentials, hashlib.sha256).hexdigest()
+
+    def get(self, key):
+        """
+        Returns the (user id, password hash) the credentials were checked against, or None.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            user_id, password_hash, expires = entry
+            if expires < time.time():
+                del self.entries[key]
+                return None
+            return user_id, password_hash
+
+    def set(self, key, user):
+        with self.lock:
+            if len(self.entries) >= settings.NODE_AUTH_CACHE_SIZE:
+                self.purge()
+            expires = time.time() + settings.NODE_AUTH_CACHE_TIMEOUT
+            self.entries[key] = (user.pk, user.password, expires)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def purge(self):
+        """
+        Drops expired entries, or everything if the cache is still full.
+        Expects the lock to be held.
+        """
+        now = time.time()
+        for key, entry in self.entries.items():
+            if entry[2] < now:
+                del self.entries[key]
+        if len(self.entries) >= settings.NODE_AUTH_CACHE_SIZE:
+            self.entries.clear()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+credential_cache = CredentialCache()
+
+class NodeBasicAuthentication(BasicAuthentication):
+    """
+    Basic authentication that skips the password hasher for node accounts
+    (Node.foreignUserAccessAccount) whose credentials were checked recently.
+    A cached entry is only used while the user's stored password hash is unchanged,
+    so changing the node's password invalidates it.
+    Everyone else is checked every time like BasicAuthentication does.
+    """
+    def authenticate_credentials(self, userid, password):
+        key = credential_cache.make_key(userid, password)
+        cached = credential_cache.get(key)
+        if cached is not None:
+            user_id, password_hash = cached
+            try:
+                user = User.objects.get(pk=user_id)
+            except User.DoesNotExist:
+                user = None
+            if user and user.is_active and user.password == password_hash and user.get_username() == userid:
+                return (user, None)
+            # The password or the account changed since we checked it.
+            credential_cache.delete(key)
+
+        user, auth = super(NodeBasicAuthentication, self).authenticate_credentials(userid, password)
+        if Node.objects.filter(foreignUserAccessAccount=user).exists():
+            credential_cache.set(key, user)
+        return (user, auth)
@@ -0,0 +1,15 @@
+from socknet.models import Author
+
+def pending_friend_requests(request):
+    """
+    Puts the user's pending friend request count, for the navbar badge, in every template's context.
+    The count is kept on the author by the signals, so this is just the author row, which
+    the rest of the page loads anyway.
+    """
+    count = 0
+    if request.user.is_authenticated:
+        try:
+            count = request.user.author.pending_friend_request_count
+        except Author.DoesNotExist:
+            pass
+    return {'pending_friend_request_count': count}
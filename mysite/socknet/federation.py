@@ -0,0 +1,233 @@
+import json
+import requests
+from datetime import timedelta
+from itertools import islice
+
+from django.conf import settings
+from django.db import connection, transaction, IntegrityError
+from django.utils import timezone
+
+from socknet.models import Node, ForeignPost, Author, ForeignAuthor, ForeignFriendCheck
+from socknet.serializers import PostsSerializer
+from socknet.node_client import NodeClient
+from socknet.feed_parser import PostFeed
+from socknet.utils import call_concurrently, update_friend_status
+
+# Bytes read from a node's response at a time, and posts stored per query
+FEED_CHUNK_SIZE = 64 * 1024
+STORE_BATCH_SIZE = 100
+
+def iter_node_posts(node, path='posts', cache=None, max_posts=None, state=None):
+    """
+    Yields the post json objects of a node's post list (or a single post) one at a time, reading
+    the response as it arrives and following its next links page by page, as long as they point at
+    the node itself (they are sent its credentials and count towards its health). Stops after max_posts
+    (NODE_FEED_MAX_POSTS by default). cache is passed on to NodeClient.get for the first page, a
+    page too large to be cached is read as it arrives like the others.
+    Raises when a page can't be used, the posts yielded before that are fine to use.
+    If a state dict is given, state['complete'] is set once every page was read.
+    """
+    client = NodeClient(node)
+    max_posts = max_posts or settings.NODE_FEED_MAX_POSTS
+    count = 0
+    seen = set()
+    if state is not None:
+        state['complete'] = False
+    while path and path not in seen:
+        seen.add(path)
+        print "\nFetching Post data from Node: " + node.name + " " + client.url(path)
+        if cache is None:
+            response = client.get(path, stream=True)
+        else:
+            response = client.get(path, cache=cache)
+        try:
+            if response.status_code != 200:
+                raise ValueError("Response code was bad: " + str(response.status_code))
+            feed = PostFeed(response.iter_content(FEED_CHUNK_SIZE), settings.NODE_FEED_MAX_BYTES, response.encoding or 'utf-8')
+            page_count = 0
+            for post_json in feed:
+                yield post_json
+                page_count += 1
+                count += 1
+                if count >= max_posts:
+                    print("Stopped reading posts from " + node.name + " after " + str(count))
+                    return
+        finally:
+            # Gives the connection back to the pool even if the body wasn't read to the end
+            response.close()
+        path = feed.fields.get('next') if page_count else None
+        cache = None
+        if path and not client.is_own_url(path):
+            print("Not following the next link of " + node.name + " to another host: " + path)
+            return
+    if state is not None:
+        state['complete'] = True
+
+def parse_posts(node, posts_json):
+    """
+    Validates the posts with PostsSerializer and returns the ForeignPost fields of each, by post id.
+    Invalid posts are left out.
+    """
+    parsed = {}
+    for post_json in posts_json:
+        serializer = PostsSerializer(data=post_json)
+        if not serializer.is_valid() or 'id' not in post_json:
+            # Ignore posts that are not valid
+            print("Error from group: " + node.name + ", serializer is not valid.")
+            print(serializer.errors)
+            continue
+        post_data = serializer.validated_data
+        post_author = post_data['author']
+        content_type = post_data['contentType']
+        parsed[str(post_json['id'])] = {
+            'title': post_data['title'],
+            'description': post_data.get('description', ''),
+            'content': post_data['content'],
+            'content_type': content_type,
+            'markdown': content_type == "text/markdown" or content_type == "text/x-markdown",
+            'visibility': post_data['visibility'],
+            'published': post_data['published'],
+            'author_id': post_author['id'],
+            'author_display_name': post_author['displayName'],
+            'author_host': post_author['host'],
+            'comments_json': json.dumps(post_json.get('comments') or []),
+        }
+    return parsed
+
+def store_posts(node, posts_json, listed):
+    """
+    Upserts the node's posts into ForeignPost by (node, post id).
+    Rows that didn't change aren't written. Returns the number of posts created or updated.
+    """
+    parsed = parse_posts(node, posts_json)
+    existing = dict((p.post_id, p) for p in ForeignPost.objects.filter(node=node, post_id__in=list(parsed)))
+    changed = 0
+    new_posts = []
+    for post_id, fields in parsed.items():
+        post = existing.get(post_id)
+        if post is None:
+            post = ForeignPost(node=node, post_id=post_id, listed=listed, **fields)
+            # bulk_create doesn't call save()
+            post.render_content()
+            new_posts.append(post)
+        elif any(getattr(post, name) != value for name, value in fields.items()) or (listed and not post.listed):
+            for name, value in fields.items():
+                setattr(post, name, value)
+            post.listed = post.listed or listed
+            post.save()
+            changed += 1
+    try:
+        with transaction.atomic():
+            ForeignPost.objects.bulk_create(new_posts)
+    except IntegrityError:
+        # Another sync stored some of them in the meantime
+        for post in new_posts:
+            fields = parsed[post.post_id]
+            if listed:
+                fields = dict(fields, listed=True)
+            ForeignPost.objects.update_or_create(node=node, post_id=post.post_id, defaults=fields)
+    return changed + len(new_posts)
+
+def sync_node_posts(node):
+    """
+    Copies the node's post list into ForeignPost, STORE_BATCH_SIZE posts at a time as they
+    are read, and records the outcome on the node. When the whole list was read, the node's
+    posts that are no longer in it (deleted or not public anymore) are unlisted.
+    """
+    count = 0
+    started = timezone.now()
+    state = {}
+    posts = iter_node_posts(node, state=state)
+    try:
+        while True:
+            batch = list(islice(posts, STORE_BATCH_SIZE))
+            if not batch:
+                break
+            count += store_posts(node, batch, listed=True)
+            post_ids = [str(post_json['id']) for post_json in batch if isinstance(post_json, dict) and 'id' in post_json]
+            ForeignPost.objects.filter(node=node, post_id__in=post_ids).update(last_listed=started)
+    except Exception as e:
+        Node.objects.filter(id=node.id).update(posts_sync_error=str(e) or e.__class__.__name__)
+        raise
+    if state['complete']:
+        unlisted = ForeignPost.objects.filter(node=node, listed=True).exclude(last_listed__gte=started).update(listed=False)
+        if unlisted:
+            print("Unlisted " + str(unlisted) + " posts no longer listed by " + node.name)
+    Node.objects.filter(id=node.id).update(posts_synced_on=timezone.now(), posts_sync_error='')
+    return count
+
+def refresh_foreign_post(node, post_id, cache=None):
+    """
+    Fetches one post (with its comments) from the node, stores it and returns the ForeignPost.
+    """
+    store_posts(node, list(iter_node_posts(node, 'posts/' + str(post_id), cache)), listed=False)
+    return ForeignPost.objects.select_related('node').get(node=node, post_id=str(post_id))
+
+def get_friendships_to_check(batch_size):
+    """
+    Returns up to batch_size (author id, foreign author id) pairs, friendships and friend requests
+    we sent, that weren't checked in the last FOREIGN_FRIEND_CHECK_INTERVAL seconds.
+    Pairs never checked come first, then the ones checked the longest ago.
+    """
+    quote = connection.ops.quote_name
+    relations = []
+    for through in (Author.foreign_friends.through, Author.foreign_friends_im_following.through):
+        relations.append("SELECT {author}, {foreign} FROM {table}".format(
+            table=quote(through._meta.db_table),
+            author=quote(through._meta.get_field('author').column),
+            foreign=quote(through._meta.get_field('foreignauthor').column)))
+    check = ForeignFriendCheck._meta
+    # The pair columns of both join tables are named alike, so the union keeps their names
+    sql = ("SELECT pairs.{author}, pairs.{foreign} FROM ({pairs}) pairs"
+        " LEFT OUTER JOIN {table} c ON c.{check_author} = pairs.{author} AND c.{check_foreign} = pairs.{foreign}"
+        " WHERE c.{last_checked} IS NULL OR c.{last_checked} < %s"
+        " ORDER BY c.{last_checked} IS NOT NULL, c.{last_checked} LIMIT %s").format(
+            pairs=" UNION ".join(relations),
+            author=quote(Author.foreign_friends.through._meta.get_field('author').column),
+            foreign=quote(Author.foreign_friends.through._meta.get_field('foreignauthor').column),
+            table=quote(check.db_table),
+            check_author=quote(check.get_field('author').column),
+            check_foreign=quote(check.get_field('foreign_author').column),
+            last_checked=quote(check.get_field('last_checked').column))
+    since = timezone.now() - timedelta(seconds=settings.FOREIGN_FRIEND_CHECK_INTERVAL)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [connection.ops.adapt_datetimefield_value(since), batch_size])
+        rows = cursor.fetchall()
+    return [(Author._meta.pk.to_python(author_id), ForeignAuthor._meta.pk.to_python(foreign_id))
+            for author_id, foreign_id in rows]
+
+def reconcile_node_friendships(pairs):
+    """
+    Checks (local author, foreign author) pairs of one node with update_friend_status, one after the other.
+    A pair whose answer can't be used still counts as checked, so it waits for the next interval instead
+    of holding up the others. Stops when the node can't be reached. Returns the number of pairs checked.
+    """
+    checked = 0
+    for author, foreign_author in pairs:
+        try:
+            update_friend_status(author, foreign_author)
+        except requests.exceptions.RequestException as error:
+            print("Stopped checking friendships with " + foreign_author.node.name + ": " + str(error))
+            break
+        ForeignFriendCheck.objects.update_or_create(author=author, foreign_author=foreign_author,
+            defaults={'last_checked': timezone.now()})
+        checked += 1
+    return checked
+
+def reconcile_foreign_friends(batch_size, deadline):
+    """
+    Brings the friendships with foreign authors due for a check up to date, asking the nodes concurrently.
+    Returns the call_concurrently results and failures, by node.
+    """
+    pairs = get_friendships_to_check(batch_size)
+    authors = Author.objects.in_bulk(set(author_id for author_id, foreign_id in pairs))
+    foreign_authors = ForeignAuthor.objects.select_related('node').in_bulk(set(foreign_id for author_id, foreign_id in pairs))
+    by_node = {}
+    for author_id, foreign_id in pairs:
+        foreign_author = foreign_authors[foreign_id]
+        by_node.setdefault(foreign_author.node_id, []).append((authors[author_id], foreign_author))
+    results, failures = call_concurrently(reconcile_node_friendships, list(by_node.values()), deadline)
+    # Report them by node, every pair of a batch has the same node
+    results = [(node_pairs[0][1].node, checked) for node_pairs, checked in results]
+    failures = [(node_pairs[0][1].node, reason) for node_pairs, reason in failures]
+    return results, failures
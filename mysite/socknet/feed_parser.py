@@ -0,0 +1,96 @@
+import codecs
+import json
+import re
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+DECODER = json.JSONDecoder()
+
+class FeedError(ValueError):
+    pass
+
+class PostFeed(object):
+    """
+    Reads a posts document ({"posts": [...], "next": ..., ...}) from an iterable of byte chunks
+    without holding all of it. Iterating yields the post objects one at a time, the other top
+    level values are in fields once it is done. A node that answers posts/<id> with the post
+    itself instead of a list gives that one post.
+    Raises FeedError when the body isn't valid json or is longer than max_bytes.
+    """
+    def __init__(self, chunks, max_bytes, encoding='utf-8'):
+        self.chunks = iter(chunks)
+        self.max_bytes = max_bytes
+        self.decoder = codecs.getincrementaldecoder(encoding)()
+        self.buffer = u''
+        self.pos = 0
+        self.bytes_read = 0
+        self.fields = {}
+
+    def __iter__(self):
+        self._expect('{')
+        if self._peek() == '}':
+            return
+        while True:
+            key = self._value()
+            self._expect(':')
+            if key == 'posts' and self._peek() == '[':
+                self.pos += 1
+                if self._peek() == ']':
+                    self.pos += 1
+                else:
+                    while True:
+                        yield self._value()
+                        if self._expect(',]') == ']':
+                            break
+            else:
+                value = self._value()
+                if key == 'posts' and isinstance(value, dict):
+                    yield value
+                else:
+                    self.fields[key] = value
+            if self._expect(',}') == '}':
+                return
+
+    def _fill(self):
+        """ Reads the next chunk into the buffer, returns False at the end of the body. """
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            return False
+        self.bytes_read += len(chunk)
+        if self.bytes_read > self.max_bytes:
+            raise FeedError("Response is larger than " + str(self.max_bytes) + " bytes")
+        # What was already parsed isn't needed anymore
+        self.buffer = self.buffer[self.pos:] + self.decoder.decode(chunk)
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        """ Skips whitespace and returns the next character, or '' at the end of the body. """
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ''
+
+    def _expect(self, characters):
+        character = self._peek()
+        if not character or character not in characters:
+            raise FeedError("Expected one of " + characters + " at byte " + str(self.bytes_read))
+        self.pos += 1
+        return character
+
+    def _value(self):
+        """ Decodes the next json value, reading more of the body until it is complete. """
+        self._peek()
+        while True:
+            try:
+                value, end = DECODER.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if not self._fill():
+                    raise FeedError("Invalid or incomplete json at byte " + str(self.bytes_read))
+                continue
+            # A number at the end of the buffer may go on in the next chunk
+            if end == len(self.buffer) and self._fill():
+                continue
+            self.pos = end
+            return value
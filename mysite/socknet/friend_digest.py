@@ -0,0 +1,76 @@
+import base64
+import hashlib
+import math
+import struct
+
+class FriendDigest(object):
+    """
+    A Bloom filter of a set of author uuids, so another node can rule out that one of its
+    authors is a friend without getting the whole friend list. might_contain() is never
+    wrong when it says no, and says yes for an author that isn't in the set about
+    false_positive_rate of the time. Exact answers still come from the friends api.
+
+    For a uuid in canonical form (lowercase, with dashes) its i-th bit, for i in 0 .. hashes - 1,
+    is the first 8 bytes of the sha256 digest of "<uuid>:<i>" as a big-endian unsigned integer,
+    mod bits. Each index has its own hash, so the bits of one uuid don't fall into the short
+    cycles that double hashing gives when bits and the step share factors. Bit n is bit n % 8
+    (least significant first) of byte n // 8 of the filter.
+    """
+    ALGORITHM = "bloom-sha256-indexed"
+    MIN_BITS = 64
+
+    def __init__(self, bits, hashes, count, false_positive_rate, data):
+        self.bits = bits
+        self.hashes = hashes
+        self.count = count
+        self.false_positive_rate = false_positive_rate
+        self.data = bytearray(data)
+
+    @classmethod
+    def build(cls, author_ids, false_positive_rate):
+        author_ids = set(str(author_id).lower() for author_id in author_ids)
+        count = len(author_ids)
+        # The optimal number of hashes for this false positive rate, and the size that gives it for count items
+        hashes = max(1, int(round(-math.log(false_positive_rate, 2))))
+        bits = max(cls.MIN_BITS, int(math.ceil(max(count, 1) * hashes / math.log(2))))
+        bits += -bits % 8
+        digest = cls(bits, hashes, count, false_positive_rate, bytearray(bits // 8))
+        for author_id in author_ids:
+            for bit in digest._bits(author_id):
+                digest.data[bit // 8] |= 1 << (bit % 8)
+        return digest
+
+    @classmethod
+    def from_dict(cls, data):
+        """ Reads a digest sent by as_dict(), raises ValueError if it can't be used. """
+        if data.get('algorithm') != cls.ALGORITHM:
+            raise ValueError("Unknown digest algorithm: " + str(data.get('algorithm')))
+        digest = cls(int(data['bits']), int(data['hashes']), int(data['count']),
+            float(data['false_positive_rate']), base64.b64decode(data['filter']))
+        if digest.bits <= 0 or digest.hashes <= 0 or len(digest.data) * 8 != digest.bits:
+            raise ValueError("The digest's filter doesn't match its size")
+        return digest
+
+    def _bits(self, author_id):
+        author_id = str(author_id).lower()
+        return [struct.unpack('>Q', hashlib.sha256(author_id + ':' + str(i)).digest()[:8])[0] % self.bits
+                for i in range(self.hashes)]
+
+    def might_contain(self, author_id):
+        return all(self.data[bit // 8] & (1 << (bit % 8)) for bit in self._bits(author_id))
+
+    @property
+    def version(self):
+        """ Changes whenever the filter does, used as its ETag. """
+        return hashlib.sha256(str(self.hashes) + ':' + str(self.data)).hexdigest()[:32]
+
+    def as_dict(self):
+        return {
+            'algorithm': self.ALGORITHM,
+            'version': self.version,
+            'bits': self.bits,
+            'hashes': self.hashes,
+            'count': self.count,
+            'false_positive_rate': self.false_positive_rate,
+            'filter': base64.b64encode(bytes(self.data)),
+        }
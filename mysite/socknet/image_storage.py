@@ -0,0 +1,119 @@
+import errno
+import hashlib
+import os
+import tempfile
+from io import BytesIO
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+from PIL import Image
+
+def get_image_storage():
+    """
+    Returns the image storage backend configured by IMAGE_STORAGE_BACKEND and IMAGE_STORAGE_OPTIONS.
+    """
+    return import_string(settings.IMAGE_STORAGE_BACKEND)(**settings.IMAGE_STORAGE_OPTIONS)
+
+class ImageStorage(object):
+    """
+    Stores image bytes by the sha256 digest of their content.
+    ImageServ only keeps the digest, so backends just have to implement these.
+    """
+    @staticmethod
+    def digest(data):
+        return hashlib.sha256(data).hexdigest()
+
+    def save(self, data):
+        """ Stores the bytes and returns their digest. Saving the same bytes twice keeps one copy. """
+        raise NotImplementedError
+
+    def open(self, digest):
+        """ Returns a binary file object to read the bytes from. """
+        raise NotImplementedError
+
+    def size(self, digest):
+        raise NotImplementedError
+
+    def exists(self, digest):
+        raise NotImplementedError
+
+    def delete(self, digest):
+        raise NotImplementedError
+
+class FileSystemImageStorage(ImageStorage):
+    """
+    Keeps each image in a file named by its digest under location,
+    fanned out by the first 4 hex characters: location/ab/cd/abcd...
+    """
+    def __init__(self, location):
+        self.location = location
+
+    def path(self, digest):
+        if len(digest) != 64 or any(c not in "0123456789abcdef" for c in digest):
+            raise ValueError("Invalid image digest: " + digest)
+        return os.path.join(self.location, digest[:2], digest[2:4], digest)
+
+    def save(self, data):
+        digest = self.digest(data)
+        path = self.path(digest)
+        if os.path.exists(path):
+            return digest
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+        # Write to a temporary file first so readers never see a partial image.
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                tmp_file.write(data)
+            os.rename(tmp_path, path)
+        except:
+            os.remove(tmp_path)
+            raise
+        return digest
+
+    def open(self, digest):
+        return open(self.path(digest), 'rb')
+
+    def size(self, digest):
+        return os.path.getsize(self.path(digest))
+
+    def exists(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def delete(self, digest):
+        try:
+            os.remove(self.path(digest))
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+
+def resize_image(data, width, height, quality):
+    """
+    Scales the image down to fit in width x height, keeping its aspect ratio.
+    Images with transparency are saved as PNG, everything else as JPEG.
+    Returns (bytes, content type), or None when the image already fits or can't be read,
+    in which case the original should be used as is.
+    """
+    try:
+        image = Image.open(BytesIO(data))
+        if image.size[0] <= width and image.size[1] <= height:
+            return None
+        # Lets JPEGs decode straight at a reduced scale instead of at full size.
+        image.draft('RGB', (width, height))
+        has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+        # Palette images would be resized with nearest neighbour, convert them first.
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+        image.thumbnail((width, height), Image.ANTIALIAS)
+        output = BytesIO()
+        if has_alpha:
+            image.save(output, 'PNG', optimize=True)
+            return output.getvalue(), 'image/png'
+        image.save(output, 'JPEG', quality=quality, optimize=True, progressive=True)
+        return output.getvalue(), 'image/jpeg'
+    except (IOError, ValueError) as error:
+        print "Could not resize image: " + str(error)
+        return None
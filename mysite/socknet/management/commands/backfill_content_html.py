@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+
+from socknet.models import Post, Comment, ForeignComment
+from socknet.utils import HTMLsafe
+
+class Command(BaseCommand):
+    """
+    Renders content_html for posts and comments saved before it existed, or rendered
+    by an older HTMLsafe.RENDERER_VERSION.
+    python manage.py backfill_content_html
+    """
+    help = "Renders the stored html of posts and comments that are missing it or out of date."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        for model in (Post, Comment, ForeignComment):
+            count = self.backfill(model, options['batch_size'])
+            self.stdout.write("%s: rendered %d rows" % (model.__name__, count))
+
+    def backfill(self, model, batch_size):
+        """
+        Renders the stale rows of a model in batches.
+        Uses update() so created_on (auto_now) is not touched and posts don't jump to the top.
+        """
+        count = 0
+        stale = model.objects.exclude(content_html_version=HTMLsafe.RENDERER_VERSION).order_by('pk')
+        last_pk = None
+        while True:
+            batch = stale
+            if last_pk is not None:
+                batch = batch.filter(pk__gt=last_pk)
+            rows = list(batch.values_list('pk', 'markdown', 'content')[:batch_size])
+            if not rows:
+                return count
+            for pk, markdown, content in rows:
+                model.objects.filter(pk=pk).update(
+                    content_html=HTMLsafe.get_converted_content(markdown, content),
+                    content_html_version=HTMLsafe.RENDERER_VERSION)
+            count += len(rows)
+            last_pk = rows[-1][0]
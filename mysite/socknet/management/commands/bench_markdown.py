@@ -0,0 +1,73 @@
+import timeit
+import HTMLParser
+
+import CommonMark
+from django.core.management.base import BaseCommand
+from django.utils import html
+
+from socknet.utils import HTMLsafe
+
+def legacy_unescape_markdown(text):
+    """
+    The previous HTMLsafe._unescape_markdown, kept as the reference the
+    current one has to match (see test_utils) and to compare timings against.
+    """
+    tmp = text
+    # Anything within <code></code> will be decoded.
+    parser = HTMLParser.HTMLParser()
+    # Split by the commonmark generated tags (they're not user generated).
+    tmp = tmp.split('<')
+    starts = 0
+    ends = 0
+    code_tag_contents = []
+    for each in tmp:
+        if each.replace(' ','').startswith('code>'):
+            starts += 1
+        if each.replace(' ','').startswith('/code>'):
+            ends += 1
+        # if currently within a <code> tag, decode html escape chars.
+        if starts > ends:
+            code_tag_contents.append(parser.unescape(each))
+        else:
+            code_tag_contents.append(each)
+    return '<'.join(code_tag_contents)
+
+def render(markdown_text):
+    """
+    Renders markdown the way HTMLsafe.get_converted_content does, up to the unescape step.
+    """
+    mark = html.conditional_escape(markdown_text).replace('&gt;', '>')
+    return CommonMark.commonmark(mark)
+
+def sample_post():
+    """ A post at the 512 character limit mixing text, inline code and a code block. """
+    text = (u"# Title\n\nSome *text* with `a < b && c > d` inline and a [link](http://example.com).\n\n"
+        u"    if (x < 10 && y > 2) { return \"<b>\"; }\n\n> quoted & <escaped>\n\n")
+    return (text * 4)[:512]
+
+def sample_code_block():
+    """ A large pasted code block, roughly 200KB. """
+    line = u"    for (int i = 0; i < n && a[i] != '&'; i++) { s += \"<td>\" + a[i] + \"</td>\"; }\n"
+    return u"Pasted code:\n\n" + line * 2500
+
+class Command(BaseCommand):
+    """
+    Times HTMLsafe._unescape_markdown against the previous implementation.
+    python manage.py bench_markdown
+    """
+    help = "Benchmarks unescaping markdown for a 512 character post and a large code block."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        cases = [
+            ("512 character post", render(sample_post()), 2000),
+            ("large code block", render(sample_code_block()), 5),
+        ]
+        for name, text, number in cases:
+            if legacy_unescape_markdown(text) != HTMLsafe._unescape_markdown(text):
+                self.stderr.write("%s: output differs from the previous implementation" % name)
+            for label, func in (("previous", legacy_unescape_markdown), ("current", HTMLsafe._unescape_markdown)):
+                best = min(timeit.repeat(lambda: func(text), number=number, repeat=options['repeat']))
+                self.stdout.write("%s (%d chars), %s: %.1f us per call" % (name, len(text), label, best / number * 1e6))
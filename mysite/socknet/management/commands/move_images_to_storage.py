@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from socknet.models import ImageServ
+from socknet.image_storage import get_image_storage
+
+class Command(BaseCommand):
+    """
+    Moves image bytes still kept in the ImageServ.image column into the image storage.
+    python manage.py move_images_to_storage
+    """
+    help = "Moves image blobs out of the database into the image storage, in batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=50)
+
+    def handle(self, *args, **options):
+        storage = get_image_storage()
+        moved = 0
+        while True:
+            with transaction.atomic():
+                # Only batch_size blobs are loaded into memory at a time.
+                batch = list(ImageServ.objects.filter(image_hash='').select_for_update()
+                    .only('id', 'image').order_by('pk')[:options['batch_size']])
+                if not batch:
+                    break
+                for image in batch:
+                    digest = storage.save(bytes(image.image))
+                    # update() so created_on (auto_now) is not touched
+                    ImageServ.objects.filter(pk=image.pk).update(image_hash=digest, image=b'')
+            moved += len(batch)
+            self.stdout.write("Moved %d images" % moved)
+        self.stdout.write("Done, moved %d images" % moved)
@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from socknet.federation import reconcile_foreign_friends
+
+class Command(BaseCommand):
+    """
+    Checks friendships and friend requests with foreign authors against their nodes,
+    the pages only read what this stored.
+    python manage.py reconcile_foreign_friends                  checks once (e.g. from cron)
+    python manage.py reconcile_foreign_friends --interval 60    keeps checking every minute
+    """
+    help = "Updates friendships with foreign authors that are due for a check with their node."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=int, default=0,
+            help="Seconds to wait between runs, runs only once if not given.")
+        parser.add_argument('--batch-size', type=int, default=500,
+            help="Most friendships to check in one run.")
+        parser.add_argument('--deadline', type=int, default=120,
+            help="Seconds to wait for all the nodes in one run.")
+
+    def handle(self, *args, **options):
+        while True:
+            results, failures = reconcile_foreign_friends(options['batch_size'], options['deadline'])
+            for node, checked in results:
+                self.stdout.write("%s: %d friendships checked" % (node.name, checked))
+            for node, reason in failures:
+                self.stderr.write("%s: skipped, %s" % (node.name, reason))
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
+            close_old_connections()
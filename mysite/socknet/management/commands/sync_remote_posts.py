@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from socknet.federation import sync_node_posts
+from socknet.models import Node
+from socknet.utils import call_concurrently
+
+class Command(BaseCommand):
+    """
+    Copies the posts of every Node into ForeignPost, the remote posts pages read from there.
+    python manage.py sync_remote_posts                  syncs once (e.g. from cron)
+    python manage.py sync_remote_posts --interval 60    keeps syncing every minute
+    """
+    help = "Pulls the post list of every node into the local remote posts table."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=int, default=0,
+            help="Seconds to wait between syncs, syncs only once if not given.")
+        parser.add_argument('--deadline', type=int, default=120,
+            help="Seconds to wait for all the nodes in one sync.")
+
+    def handle(self, *args, **options):
+        while True:
+            self.sync(options['deadline'])
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
+            close_old_connections()
+
+    def sync(self, deadline):
+        results, failures = call_concurrently(sync_node_posts, list(Node.objects.all()), deadline)
+        for node, count in results:
+            self.stdout.write("%s: %d posts stored" % (node.name, count))
+        for node, reason in failures:
+            self.stderr.write("%s: skipped, %s" % (node.name, reason))
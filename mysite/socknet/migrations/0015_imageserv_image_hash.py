@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-17 11:23
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('socknet', '0014_content_html'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imageserv',
+            name='image_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+        migrations.AlterField(
+            model_name='imageserv',
+            name='image',
+            field=models.BinaryField(blank=True),
+        ),
+    ]
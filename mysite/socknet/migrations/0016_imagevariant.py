@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-17 11:26
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('socknet', '0015_imageserv_image_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageVariant',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('size', models.CharField(max_length=16)),
+                ('imagetype', models.CharField(max_length=12)),
+                ('image_hash', models.CharField(db_index=True, max_length=64)),
+                ('image', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='variants', to='socknet.ImageServ')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='imagevariant',
+            unique_together=set([('image', 'size')]),
+        ),
+    ]
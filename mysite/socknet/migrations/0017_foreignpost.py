@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-17 11:29
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('socknet', '0016_imagevariant'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ForeignPost',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content_html', models.TextField(blank=True, default=b'', editable=False)),
+                ('content_html_version', models.PositiveSmallIntegerField(default=0, editable=False)),
+                ('post_id', models.CharField(max_length=64)),
+                ('title', models.TextField()),
+                ('description', models.TextField(blank=True)),
+                ('content', models.TextField(blank=True)),
+                ('content_type', models.CharField(max_length=32)),
+                ('markdown', models.BooleanField()),
+                ('visibility', models.CharField(max_length=255)),
+                ('published', models.DateTimeField()),
+                ('author_id', models.CharField(max_length=64)),
+                ('author_display_name', models.TextField()),
+                ('author_host', models.TextField(blank=True)),
+                ('comments_json', models.TextField(default=b'[]')),
+                ('listed', models.BooleanField(default=False)),
+                ('synced_on', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='node',
+            name='posts_sync_error',
+            field=models.TextField(blank=True, default=b'', editable=False),
+        ),
+        migrations.AddField(
+            model_name='node',
+            name='posts_synced_on',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='foreignpost',
+            name='node',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='foreign_posts', to='socknet.Node'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='foreignpost',
+            unique_together=set([('node', 'post_id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='foreignpost',
+            index_together=set([('published', 'id')]),
+        ),
+    ]
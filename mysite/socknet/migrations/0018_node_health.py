@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-17 11:33
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('socknet', '0017_foreignpost'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='node',
+            name='circuit_open_until',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='node',
+            name='consecutive_failures',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='node',
+            name='last_error',
+            field=models.TextField(blank=True, default=b'', editable=False),
+        ),
+        migrations.AddField(
+            model_name='node',
+            name='last_failure_on',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='node',
+            name='last_success_on',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='node',
+            name='latency_ms',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+    ]
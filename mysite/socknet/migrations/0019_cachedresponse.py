@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-17 11:35
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('socknet', '0018_node_health'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CachedResponse',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url_hash', models.CharField(max_length=64, unique=True)),
+                ('url', models.TextField()),
+                ('content', models.BinaryField()),
+                ('encoding', models.CharField(blank=True, max_length=32)),
+                ('content_type', models.CharField(blank=True, max_length=255)),
+                ('etag', models.CharField(blank=True, max_length=255)),
+                ('last_modified', models.CharField(blank=True, max_length=64)),
+                ('fetched_on', models.DateTimeField()),
+                ('node', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cached_responses', to='socknet.Node')),
+            ],
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-17 11:37
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('socknet', '0019_cachedresponse'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ForeignFriendCheck',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_checked', models.DateTimeField()),
+                ('author', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='foreign_friend_checks', to='socknet.Author')),
+                ('foreign_author', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='friend_checks', to='socknet.ForeignAuthor')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='foreignfriendcheck',
+            unique_together=set([('author', 'foreign_author')]),
+        ),
+    ]
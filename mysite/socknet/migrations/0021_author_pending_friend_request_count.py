@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-17 11:51
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def count_pending_friend_requests(apps, schema_editor):
+    Author = apps.get_model('socknet', 'Author')
+    for author in Author.objects.all():
+        local_pending = author.my_followers.exclude(pk__in=author.ignored.all()).exclude(pk__in=author.friends.all())
+        count = local_pending.count() + author.pending_foreign_friends.count()
+        Author.objects.filter(pk=author.pk).update(pending_friend_request_count=count)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('socknet', '0020_foreignfriendcheck'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='author',
+            name='pending_friend_request_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_pending_friend_requests, migrations.RunPython.noop),
+    ]
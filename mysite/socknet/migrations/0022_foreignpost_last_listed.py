@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-17 12:16
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('socknet', '0021_author_pending_friend_request_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='foreignpost',
+            name='last_listed',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -1,14 +1,20 @@
-from django.db import models
+from django.db import models, connection, transaction, IntegrityError
+from django.db.models.expressions import RawSQL
+from django.conf import settings
 from django.urls import reverse
+from django.utils import timezone
 from django.contrib.auth.models import User
-from socknet.utils import HTMLsafe, AuthorInfo
+from socknet.utils import HTMLsafe, AuthorInfo, RemoteComment
 from django.contrib.postgres.fields import ArrayField
 # for images auto delete
 from django.db.models.signals import pre_delete
 from django.dispatch import receiver
 import uuid
+import json
 from itertools import chain
 from socknet.utils import is_FOAF_local
+from socknet.image_storage import get_image_storage, resize_image
+from io import BytesIO
 
 class Node(models.Model):
     """
@@ -21,6 +27,23 @@ class Node(models.Model):
     # String UserID and Password to access foreign node via basic auth
     foreignNodeUser = models.CharField(max_length=256, null=True)
     foreignNodePass = models.CharField(max_length=256, null=True)
+    # Last successful sync_remote_posts run and why the last one failed (empty if it didn't)
+    posts_synced_on = models.DateTimeField(null=True, blank=True, editable=False)
+    posts_sync_error = models.TextField(blank=True, default='', editable=False)
+    # Health of the node, NodeClient updates these after every request it sends.
+    consecutive_failures = models.PositiveIntegerField(default=0, editable=False)
+    last_success_on = models.DateTimeField(null=True, blank=True, editable=False)
+    last_failure_on = models.DateTimeField(null=True, blank=True, editable=False)
+    last_error = models.TextField(blank=True, default='', editable=False)
+    # Moving average of how long successful requests took
+    latency_ms = models.FloatField(null=True, blank=True, editable=False)
+    # Nothing is sent to the node before then, see NODE_FAILURE_THRESHOLD
+    circuit_open_until = models.DateTimeField(null=True, blank=True, editable=False)
+
+    def is_available(self):
+        """ False while the circuit breaker keeps requests from being sent to the node.
+        Once it is True again only one request is sent until the node answers, see NodeClient. """
+        return self.circuit_open_until is None or self.circuit_open_until <= timezone.now()
 
     def __str__(self):
         return self.name
@@ -39,6 +62,69 @@ class ForeignAuthor(models.Model):
     def __str__(self):
         return self.display_name
 
+class AuthorQuerySet(models.QuerySet):
+    """ Query operations for the Author table. """
+    def FOAF_of(self, viewer):
+        """
+        The authors in the queryset that have a friend, local or foreign, in common with viewer.
+        It is one EXISTS per kind of friend over the join tables, no friend list leaves the database.
+        """
+        quote = connection.ops.quote_name
+        tables = []
+        for through, author_field, friend_field in ((self.model.friends.through, 'from_author', 'to_author'),
+                                                     (self.model.foreign_friends.through, 'author', 'foreignauthor')):
+            tables.append({
+                'table': quote(through._meta.db_table),
+                'author': quote(through._meta.get_field(author_field).column),
+                'friend': quote(through._meta.get_field(friend_field).column),
+            })
+        exists = ("EXISTS (SELECT 1 FROM {table} theirs INNER JOIN {table} mine ON theirs.{friend} = mine.{friend}"
+            " WHERE theirs.{author} = {outer}.{pk} AND mine.{author} = %s)")
+        outer = {'outer': quote(self.model._meta.db_table), 'pk': quote(self.model._meta.pk.column)}
+        where = " OR ".join(exists.format(**dict(table, **outer)) for table in tables)
+        return self.extra(where=["(" + where + ")"], params=[viewer.pk] * len(tables))
+
+    def are_friends(self, pairs):
+        """
+        Takes (author id, author id) pairs, either one can be a foreign author, and returns
+        whether each pair are friends. Two queries whatever the number of pairs.
+        """
+        pairs = [(uuid.UUID(str(id1)), uuid.UUID(str(id2))) for id1, id2 in pairs]
+        ids = set(author_id for pair in pairs for author_id in pair)
+        local = set(self.model.friends.through.objects.filter(from_author__uuid__in=ids, to_author__uuid__in=ids)
+            .values_list('from_author__uuid', 'to_author__uuid'))
+        foreign = set(self.model.foreign_friends.through.objects.filter(author__uuid__in=ids, foreignauthor_id__in=ids)
+            .values_list('author__uuid', 'foreignauthor_id'))
+        return [pair in local or pair in foreign or pair[::-1] in foreign for pair in pairs]
+
+    def update_pending_friend_request_counts(self):
+        """
+        Recounts the pending friend requests of the authors in the queryset and
+        returns the new counts by author pk. One UPDATE with a count subquery per kind of
+        request (the followers that aren't friends or ignored, see get_pending_local_friend_requests,
+        and the foreign requests), and one query to read the counts back, whatever the number of authors.
+        """
+        quote = connection.ops.quote_name
+
+        def columns(through, *fields):
+            names = dict((field, quote(through._meta.get_field(field).column)) for field in fields)
+            names['table'] = quote(through._meta.db_table)
+            return names
+
+        follow = columns(self.model.who_im_following.through, 'from_author', 'to_author')
+        not_in = ("NOT EXISTS (SELECT 1 FROM {table} WHERE {table}.{from_author} = {outer}.{pk}"
+            " AND {table}.{to_author} = follow.{follower})")
+        outer = {'outer': quote(self.model._meta.db_table), 'pk': quote(self.model._meta.pk.column),
+                 'follower': follow['from_author']}
+        local = ("(SELECT COUNT(*) FROM {table} follow WHERE follow.{to_author} = {outer}.{pk} AND "
+            .format(**dict(follow, **outer))
+            + " AND ".join(not_in.format(**dict(columns(through, 'from_author', 'to_author'), **outer))
+                for through in (self.model.ignored.through, self.model.friends.through)) + ")")
+        foreign = "(SELECT COUNT(*) FROM {table} WHERE {table}.{author} = {outer}.{pk})".format(
+            **dict(columns(self.model.pending_foreign_friends.through, 'author'), **outer))
+        self.update(pending_friend_request_count=RawSQL(local + " + " + foreign, []))
+        return dict(self.values_list('pk', 'pending_friend_request_count'))
+
 class Author(models.Model):
     """
     Represents an author
@@ -51,6 +137,7 @@ class Author(models.Model):
     """
     user = models.OneToOneField(User)
     uuid = models.UUIDField(default=uuid.uuid4, editable=False)
+    objects = AuthorQuerySet.as_manager()
 
     # Friends and followers are separate --> I can be both a friend and a follower
     # ignored is for friend requests you have declined, just means it won't show up as pending
@@ -71,9 +158,25 @@ class Author(models.Model):
     url = models.URLField(blank=True)
     host = models.URLField(default='')
 
+    # Kept up to date by the signals whenever following, ignoring, friends or foreign
+    # friend requests change, so the navbar doesn't have to count them on every page.
+    pending_friend_request_count = models.PositiveIntegerField(default=0, editable=False)
+
     def __str__(self):
         return self.user.get_username()
 
+    def save(self, *args, **kwargs):
+        """
+        Saving an author that is already in the database writes every field but
+        pending_friend_request_count, which the signals keep up to date there and an older copy
+        must not overwrite. Since that is an update_fields save, an author whose row was deleted
+        in the meantime raises DatabaseError instead of being inserted again.
+        """
+        if not self._state.adding and 'update_fields' not in kwargs:
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != 'pending_friend_request_count']
+        super(Author, self).save(*args, **kwargs)
+
     def get_site(self):
         # Get the url for the author
         return Site.objects.get_current().domain
@@ -129,7 +232,7 @@ class Author(models.Model):
         return self.friends
 
     def get_pending_friend_request_count(self):
-        return len(self.get_pending_friend_requests())
+        return self.pending_friend_request_count
 
     def accept_friend_request(self, requester_uuid, is_local):
         """
@@ -213,11 +316,44 @@ class Author(models.Model):
         """
         Returns a list all of the authors local and foreign friend uuids.
         """
-        local_uuids = [friend.uuid for friend in self.friends.all()]
-        foreign_uuids = [friend.id for friend in self.foreign_friends.all()]
+        local_uuids = list(self.friends.values_list('uuid', flat=True))
+        foreign_uuids = list(self.foreign_friends.values_list('id', flat=True))
         return local_uuids + foreign_uuids
 
-class Post(models.Model):
+class RenderedContent(models.Model):
+    """
+    Keeps the html of the content (see HTMLsafe.get_converted_content) in content_html.
+    It is rendered whenever the row is saved instead of every time it is displayed,
+    rows rendered by an older HTMLsafe.RENDERER_VERSION are rendered on the fly until
+    the backfill_content_html command updates them.
+    """
+    content_html = models.TextField(blank=True, default='', editable=False)
+    content_html_version = models.PositiveSmallIntegerField(default=0, editable=False)
+
+    def render_content(self):
+        self.content_html = HTMLsafe.get_converted_content(self.markdown, self.content)
+        self.content_html_version = HTMLsafe.RENDERER_VERSION
+
+    def save(self, *args, **kwargs):
+        self.render_content()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and ('content' in update_fields or 'markdown' in update_fields):
+            kwargs['update_fields'] = list(update_fields) + ['content_html', 'content_html_version']
+        super(RenderedContent, self).save(*args, **kwargs)
+
+    def view_content(self):
+        """ Retrieves content to be displayed as html, it is assumed safe
+        due to HTMLsafe's get_converted_content() applies HTML escapes already.
+        """
+        if self.content_html_version != HTMLsafe.RENDERER_VERSION:
+            # Not saved yet, or rendered by an older version.
+            return HTMLsafe.get_converted_content(self.markdown, self.content)
+        return self.content_html
+
+    class Meta:
+        abstract = True
+
+class Post(RenderedContent):
     """ Represents a post made by a user """
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     author = models.ForeignKey(Author, related_name="author")
@@ -243,12 +379,6 @@ class Post(models.Model):
         """
         return reverse('view_post', args=[str(self.id)])
 
-    def view_content(self):
-        """ Retrieves content to be displayed as html, it is assumed safe
-        due to HTMLsafe's get_converted_content() applies HTML escapes already.
-        """
-        return HTMLsafe.get_converted_content(self.markdown, self.content)
-
     def getFullEnglishVisibility(self):
         ''' Gets the full, written out English phrase
         for the visibility string'''
@@ -270,6 +400,10 @@ class Post(models.Model):
     def __unicode__(self):
         return self.author.displayName + ": " + self.content
 
+    class Meta:
+        # Keyset pagination on the posts api walks this index.
+        index_together = [['created_on', 'id']]
+
 class PostManager(models.Model):
 
     def get_local_profile_posts(self, profile_author, current_author):
@@ -324,7 +458,7 @@ class CommentQuerySet(models.QuerySet):
             results = results.order_by('-created_on',)
         return results
 
-class Comment(models.Model):
+class Comment(RenderedContent):
     """ Represents a comment made by a user """
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     objects = CommentQuerySet.as_manager()
@@ -346,12 +480,6 @@ class Comment(models.Model):
         #return reverse('list_comments_anchor', args=[str(self.parent_post.id), str(self.id)]).replace('%23', '#')
         return reverse('view_post', args=[str(self.parent_post.id)])
 
-    def view_content(self):
-        """ Retrieves content to be displayed as html, it is assumed safe
-        due to HTMLsafe's get_converted_content() applies HTML escapes already.
-        """
-        return HTMLsafe.get_converted_content(self.markdown, self.content)
-
     # enable weird characters like lenny faces taken from:
     #http://stackoverflow.com/questions/36389723/why-is-django-using-ascii-instead-of-utf-8
     def __unicode__(self):
@@ -377,7 +505,7 @@ class ForeignCommentQuerySet(models.QuerySet):
             results = results.order_by('-created_on',)
         return results
 
-class ForeignComment(models.Model):
+class ForeignComment(RenderedContent):
     """ Represents a comment made by a foreign user
     Had to make another class because can't hide/override fields according to django when normal inheriting.
     https://docs.djangoproject.com/en/1.10/topics/db/models/#field-name-hiding-is-not-permitted
@@ -396,35 +524,148 @@ class ForeignComment(models.Model):
         """
         return reverse('view_remote_post', args=[str(self.foreign_author.node.id), str(self.parent_post.id)])
 
-    def view_content(self):
-        """ Retrieves content to be displayed as html, it is assumed safe
-        due to HTMLsafe's get_converted_content() applies HTML escapes already.
-        """
-        return HTMLsafe.get_converted_content(self.markdown, self.content)
-
     # enable weird characters like lenny faces taken from:
     #http://stackoverflow.com/questions/36389723/why-is-django-using-ascii-instead-of-utf-8
     def __unicode__(self):
         return "Parent post:"+ str(self.parent_post.id) + ", Author:" + self.author.displayName + ": " + self.content
 
+class ForeignFriendCheck(models.Model):
+    """ When a local author's friendship or friend request with a foreign author was last
+    checked with the foreign author's node, see the reconcile_foreign_friends command.
+    """
+    author = models.ForeignKey(Author, related_name="foreign_friend_checks")
+    foreign_author = models.ForeignKey(ForeignAuthor, related_name="friend_checks")
+    last_checked = models.DateTimeField()
+
+    class Meta:
+        unique_together = [['author', 'foreign_author']]
+
+class CachedResponse(models.Model):
+    """ A GET response from a node kept by NodeClient.get (see NODE_RESPONSE_CACHE),
+    with the validators to ask the node if it changed.
+    """
+    node = models.ForeignKey(Node, related_name="cached_responses")
+    url_hash = models.CharField(max_length=64, unique=True)
+    url = models.TextField()
+    content = models.BinaryField()
+    encoding = models.CharField(max_length=32, blank=True)
+    content_type = models.CharField(max_length=255, blank=True)
+    etag = models.CharField(max_length=255, blank=True)
+    last_modified = models.CharField(max_length=64, blank=True)
+    fetched_on = models.DateTimeField()
+
+    def __unicode__(self):
+        return self.url
+
+class ForeignPost(RenderedContent):
+    """ A copy of a post from another node, kept up to date by the sync_remote_posts command
+    (see socknet.federation) so remote post pages don't have to wait on the nodes.
+    listed is set for posts that were in the node's post list, posts only fetched
+    one by one (e.g. when someone follows a link to it) aren't shown in the list.
+    A post that is no longer in the list after a complete sync is unlisted again.
+    """
+    node = models.ForeignKey(Node, related_name="foreign_posts")
+    post_id = models.CharField(max_length=64)
+    title = models.TextField()
+    description = models.TextField(blank=True)
+    content = models.TextField(blank=True)
+    content_type = models.CharField(max_length=32)
+    markdown = models.BooleanField()
+    visibility = models.CharField(max_length=255)
+    published = models.DateTimeField()
+    author_id = models.CharField(max_length=64)
+    author_display_name = models.TextField()
+    author_host = models.TextField(blank=True)
+    # The comments as the node sent them
+    comments_json = models.TextField(default='[]')
+    listed = models.BooleanField(default=False)
+    synced_on = models.DateTimeField(auto_now=True)
+    # When the post was last in the node's post list
+    last_listed = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        unique_together = [['node', 'post_id']]
+        index_together = [['published', 'id']]
+
+    def get_comments(self):
+        """ Returns the comments as RemoteComments, skipping the ones missing fields. """
+        comments = []
+        for c in json.loads(self.comments_json):
+            try:
+                comments.append(RemoteComment(c['id'], c.get('contentType', 'text/x-markdown'), c['comment'], c['published'],
+                    c['author']['displayName'], c['author']['id'], c['author'].get('host', ''), self.node))
+            except (KeyError, TypeError) as error:
+                print("Skipping remote comment missing " + str(error) + " on post " + self.post_id)
+        return comments
+
+    def __unicode__(self):
+        return self.node.name + ": " + self.title
+
 class ImageManager(models.Manager):
     """ Helps creating an image object.
     Taken from https://docs.djangoproject.com/en/1.10/ref/models/instances/#creating-objects
     """
     def create_image(self, img, au, pst, imgtyp):
-        img = self.create(image=img, author=au, parent_post=pst, imagetype=imgtyp)
+        # The bytes go to the image storage, the row only keeps their digest.
+        digest = get_image_storage().save(img)
+        img = self.create(image_hash=digest, author=au, parent_post=pst, imagetype=imgtyp)
         return img
 
 class ImageServ(models.Model):
-    """ Represents an image uploaded by the user. """
+    """ Represents an image uploaded by the user.
+    The bytes live in the image storage (see socknet.image_storage) under image_hash.
+    image is only used by rows that move_images_to_storage has not moved yet.
+    """
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     author = models.ForeignKey(Author, related_name="image_author")
     parent_post = models.ForeignKey(Post, related_name="image_parent_post")
     created_on = models.DateTimeField(auto_now=True)
     imagetype = models.CharField(max_length=12)
-    image = models.BinaryField()
+    image = models.BinaryField(blank=True)
+    image_hash = models.CharField(max_length=64, blank=True, db_index=True)
     objects = ImageManager()
 
+    def open_image(self):
+        """ Returns a binary file object with the image bytes. """
+        if self.image_hash:
+            return get_image_storage().open(self.image_hash)
+        return BytesIO(self.image)
+
+    def image_size(self):
+        if self.image_hash:
+            return get_image_storage().size(self.image_hash)
+        return len(self.image)
+
+    def read_image(self):
+        with self.open_image() as image_file:
+            return image_file.read()
+
+    def get_variant(self, size):
+        """ Returns the ImageVariant for a size name of settings.IMAGE_VARIANTS,
+        resizing the image the first time that size is asked for.
+        """
+        try:
+            return self.variants.get(size=size)
+        except ImageVariant.DoesNotExist:
+            pass
+        width, height = settings.IMAGE_VARIANTS[size]
+        data = self.read_image()
+        resized = resize_image(data, width, height, settings.IMAGE_VARIANT_QUALITY)
+        if resized is None:
+            # Already small enough, the variant shares the original's bytes.
+            resized = (data, self.imagetype)
+        digest = get_image_storage().save(resized[0])
+        try:
+            with transaction.atomic():
+                return ImageVariant.objects.create(image=self, size=size, image_hash=digest, imagetype=resized[1])
+        except IntegrityError:
+            # Another request made it at the same time
+            return self.variants.get(size=size)
+
+    def create_variants(self):
+        for size in settings.IMAGE_VARIANTS:
+            self.get_variant(size)
+
     def ImageServ(self, image, author, parent_post, imagetype):
         self.image = image
         self.author = author
@@ -440,6 +681,31 @@ class ImageServ(models.Model):
     def __unicode__(self):
         return self.author.displayName + ", created on " + str(self.created_on) +"  image type: " + str(self.imagetype)
 
+class ImageVariant(models.Model):
+    """ A resized copy of an ImageServ, one per size name of settings.IMAGE_VARIANTS.
+    The bytes live in the image storage under image_hash like the original's.
+    """
+    image = models.ForeignKey(ImageServ, related_name="variants")
+    size = models.CharField(max_length=16)
+    imagetype = models.CharField(max_length=12)
+    image_hash = models.CharField(max_length=64, db_index=True)
+
+    class Meta:
+        unique_together = [['image', 'size']]
+
+    def open_image(self):
+        return get_image_storage().open(self.image_hash)
+
+    def image_size(self):
+        return get_image_storage().size(self.image_hash)
+
+    def read_image(self):
+        with self.open_image() as image_file:
+            return image_file.read()
+
+    def __unicode__(self):
+        return unicode(self.image_id) + " " + self.size
+
 class AdminConfig(models.Model):
     url = models.URLField()
     sharePosts = models.BooleanField(default=True, verbose_name="Share Posts with Other Nodes")
@@ -0,0 +1,269 @@
+import hashlib
+import threading
+import time
+import urlparse
+from datetime import timedelta
+from itertools import chain
+
+import requests
+from django.conf import settings
+from django.db import connections
+from django.db.models import F, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+from requests.packages.urllib3.util.retry import Retry
+from requests.structures import CaseInsensitiveDict
+
+class NodeUnavailable(requests.exceptions.ConnectionError):
+    """ Raised instead of sending a request to a node whose circuit is open. """
+
+class NodeClient():
+    """
+    Makes the requests to another node's api, with the node's basic auth credentials.
+    Every node gets one requests.Session for the whole process, so connections to it are
+    kept alive and reused instead of opening a new TCP (and TLS) connection per call.
+    Responses are gzipped when the node supports it (requests asks for it), requests time out
+    after NODE_REQUEST_TIMEOUT seconds unless told otherwise, and GETs are retried up to
+    NODE_REQUEST_RETRIES times when connecting fails or the node answers 502, 503 or 504.
+
+    It also keeps the node's health (see Node) and acts as its circuit breaker: after
+    NODE_FAILURE_THRESHOLD failures in a row (errors or 5xx responses) requests raise
+    NodeUnavailable right away for NODE_CIRCUIT_COOLDOWN seconds instead of waiting on the node.
+    After that a single request, across processes, is let through to see if it is back.
+    """
+    # How much the latest request counts in the latency moving average
+    LATENCY_WEIGHT = 0.2
+    # Bytes read at a time from a response that may be cached
+    CACHE_CHUNK_SIZE = 64 * 1024
+    # Urls of cached responses being revalidated in the background
+    _revalidating = set()
+
+    _sessions = {}
+    _lock = threading.Lock()
+
+    def __init__(self, node):
+        self.node = node
+        # In case entered like host.com/api instead of host.com/api/
+        self.base_url = node.url if node.url.endswith('/') else node.url + '/'
+
+    @staticmethod
+    def _make_session():
+        # read=0: a node that is slow to answer won't be any faster the second time.
+        retries = Retry(total=settings.NODE_REQUEST_RETRIES, read=0, backoff_factor=0.2,
+            status_forcelist=[502, 503, 504], raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.NODE_FETCH_WORKERS, max_retries=retries)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    @classmethod
+    def forget(cls, node_id):
+        """ Closes the pooled connections of a node, e.g. when it is deleted. """
+        with cls._lock:
+            session = cls._sessions.pop(node_id, None)
+        if session is not None:
+            session.close()
+
+    def get_session(self):
+        with NodeClient._lock:
+            session = NodeClient._sessions.get(self.node.pk)
+            if session is None:
+                session = NodeClient._sessions[self.node.pk] = self._make_session()
+            return session
+
+    def url(self, path):
+        """ Paths are relative to the node's api url, full urls are used as they are. """
+        if path.startswith('http://') or path.startswith('https://'):
+            return path
+        return self.base_url + path.lstrip('/')
+
+    def is_own_url(self, path):
+        """ Whether path (see url()) is on the node's own scheme and host, so it may get the node's credentials. """
+        url, base = urlparse.urlsplit(self.url(path)), urlparse.urlsplit(self.base_url)
+        return (url.scheme.lower(), url.netloc.lower()) == (base.scheme.lower(), base.netloc.lower())
+
+    def _may_send(self):
+        """
+        Whether a request may be sent now. Once the cool-down is over the circuit is half-open:
+        the first request to claim it, by pushing circuit_open_until forward in a conditional
+        update, is sent as the probe and everyone else keeps getting NodeUnavailable until it
+        closes the circuit again (or fails and opens it for another cool-down).
+        """
+        if self.node.circuit_open_until is None:
+            return True
+        now = timezone.now()
+        if self.node.circuit_open_until > now:
+            return False
+        probe_until = now + timedelta(seconds=settings.NODE_CIRCUIT_COOLDOWN)
+        if self._node_rows().filter(circuit_open_until__lte=now).update(circuit_open_until=probe_until):
+            self.node.circuit_open_until = probe_until
+            return True
+        # Someone else is probing, or the circuit was closed since the node was loaded
+        self.node.circuit_open_until = self._node_rows().values_list('circuit_open_until', flat=True).first()
+        return self.node.circuit_open_until is None
+
+    def request(self, method, path, **kwargs):
+        if not self._may_send():
+            raise NodeUnavailable(self.node.name + " is unavailable until " + str(self.node.circuit_open_until))
+        kwargs.setdefault('timeout', settings.NODE_REQUEST_TIMEOUT)
+        kwargs.setdefault('auth', HTTPBasicAuth(self.node.foreignNodeUser, self.node.foreignNodePass))
+        start = time.time()
+        try:
+            response = self.get_session().request(method, self.url(path), **kwargs)
+        except requests.exceptions.RequestException as error:
+            self.record_failure(str(error) or error.__class__.__name__)
+            raise
+        if response.status_code >= 500:
+            self.record_failure("Response code was " + str(response.status_code))
+        else:
+            self.record_success(time.time() - start)
+        return response
+
+    def _node_rows(self):
+        # Updated with update() so requests running at the same time don't overwrite each other.
+        return self.node.__class__.objects.filter(pk=self.node.pk)
+
+    def record_success(self, seconds):
+        latency = seconds * 1000
+        self._node_rows().update(consecutive_failures=0, circuit_open_until=None, last_success_on=timezone.now(),
+            latency_ms=Coalesce(F('latency_ms') * (1 - self.LATENCY_WEIGHT) + latency * self.LATENCY_WEIGHT, Value(latency)))
+        self.node.consecutive_failures = 0
+        self.node.circuit_open_until = None
+
+    def record_failure(self, error):
+        now = timezone.now()
+        self._node_rows().update(consecutive_failures=F('consecutive_failures') + 1, last_failure_on=now, last_error=error)
+        # The failures are only reset by a success, so once the cool-down is over
+        # a single failed request opens the circuit again.
+        open_until = now + timedelta(seconds=settings.NODE_CIRCUIT_COOLDOWN)
+        self._node_rows().filter(consecutive_failures__gte=settings.NODE_FAILURE_THRESHOLD).update(circuit_open_until=open_until)
+        self.node.consecutive_failures += 1
+        if self.node.consecutive_failures >= settings.NODE_FAILURE_THRESHOLD:
+            self.node.circuit_open_until = open_until
+
+    def get(self, path, cache=None, **kwargs):
+        """
+        cache is a kind of endpoint in NODE_RESPONSE_CACHE. Its 200 responses are kept in
+        CachedResponse and used again without asking the node while they are fresh. Once
+        they are stale they are still used, but refreshed in the background, and after
+        that the node is asked again with If-None-Match / If-Modified-Since.
+        A cached response of any age is used if the node can't be reached or answers 5xx.
+        Bodies larger than the kind's maximum aren't cached, the response is given back with
+        the rest of its body still to be read.
+        """
+        if cache is None:
+            return self.request('GET', path, **kwargs)
+        fresh, stale, max_bytes = settings.NODE_RESPONSE_CACHE[cache]
+        url_hash = hashlib.sha256(self.url(path).encode('utf-8')).hexdigest()
+        cached = self.node.cached_responses.filter(url_hash=url_hash).first()
+        if cached is not None:
+            age = (timezone.now() - cached.fetched_on).total_seconds()
+            if age < fresh:
+                return self._cached_response(cached)
+            if age < fresh + stale:
+                self._revalidate_in_background(path, url_hash, cached, max_bytes)
+                return self._cached_response(cached)
+        try:
+            response = self._fetch_into_cache(path, url_hash, cached, max_bytes, **kwargs)
+        except requests.exceptions.RequestException as error:
+            if cached is None:
+                raise
+            print("Using the cached response of " + self.url(path) + ", " + str(error))
+            return self._cached_response(cached)
+        if response.status_code >= 500 and cached is not None:
+            print("Using the cached response of " + self.url(path) + ", response code was " + str(response.status_code))
+            response.close()
+            return self._cached_response(cached)
+        return response
+
+    def _fetch_into_cache(self, path, url_hash, cached, max_bytes, **kwargs):
+        headers = dict(kwargs.pop('headers', None) or {})
+        if cached is not None and cached.etag:
+            headers['If-None-Match'] = cached.etag
+        if cached is not None and cached.last_modified:
+            headers['If-Modified-Since'] = cached.last_modified
+        kwargs['stream'] = True
+        response = self.request('GET', path, headers=headers, **kwargs)
+        if response.status_code == 304 and cached is not None:
+            response.close()
+            self.node.cached_responses.filter(pk=cached.pk).update(fetched_on=timezone.now())
+            return self._cached_response(cached)
+        if response.status_code == 200:
+            # Read no more than max_bytes before deciding whether to keep it
+            chunks = []
+            size = 0
+            body = response.iter_content(self.CACHE_CHUNK_SIZE)
+            for chunk in body:
+                chunks.append(chunk)
+                size += len(chunk)
+                if size > max_bytes:
+                    print("Not caching " + self.url(path) + ", it is larger than " + str(max_bytes) + " bytes")
+                    return self._partly_read_response(response, chain(chunks, body))
+            response._content = b''.join(chunks)
+            response._content_consumed = True
+            self.node.cached_responses.update_or_create(url_hash=url_hash, defaults={
+                'url': response.url,
+                'content': response.content,
+                'encoding': response.encoding or '',
+                'content_type': response.headers.get('Content-Type', ''),
+                'etag': response.headers.get('ETag', ''),
+                'last_modified': response.headers.get('Last-Modified', ''),
+                'fetched_on': timezone.now(),
+            })
+        return response
+
+    def _revalidate_in_background(self, path, url_hash, cached, max_bytes):
+        with NodeClient._lock:
+            if url_hash in NodeClient._revalidating:
+                return
+            NodeClient._revalidating.add(url_hash)
+
+        def revalidate():
+            try:
+                # Nobody reads the answer, a body too large to cache isn't read at all
+                self._fetch_into_cache(path, url_hash, cached, max_bytes).close()
+            except Exception as error:
+                print("Could not refresh the cached response of " + self.url(path) + ", " + str(error))
+            finally:
+                with NodeClient._lock:
+                    NodeClient._revalidating.discard(url_hash)
+                # Django opens a database connection per thread, don't leave it behind.
+                connections.close_all()
+
+        thread = threading.Thread(target=revalidate)
+        thread.daemon = True
+        thread.start()
+
+    @staticmethod
+    def _cached_response(cached):
+        """ Makes a requests Response out of a CachedResponse so callers can't tell the difference. """
+        response = requests.Response()
+        response.status_code = 200
+        response.url = cached.url
+        response._content = bytes(cached.content)
+        # There's no connection to read from, iter_content() and close() use the content
+        response._content_consumed = True
+        response.encoding = cached.encoding or None
+        response.headers = CaseInsensitiveDict({'Content-Type': cached.content_type})
+        if cached.etag:
+            response.headers['ETag'] = cached.etag
+        if cached.last_modified:
+            response.headers['Last-Modified'] = cached.last_modified
+        return response
+
+    @staticmethod
+    def _partly_read_response(response, chunks):
+        """ Gives back a response whose body was already partly read, iter_content() (and so
+        content and text) starts over with the chunks read and goes on from the connection. """
+        def iter_content(chunk_size=1, decode_unicode=False):
+            if decode_unicode:
+                return requests.utils.stream_decode_response_unicode(chunks, response)
+            return chunks
+        response.iter_content = iter_content
+        return response
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
@@ -1,5 +1,6 @@
 from socknet.models import *
 from rest_framework import serializers
+from django.conf import settings
 
 class AuthorPostsSerializer(serializers.ModelSerializer):
     class Meta:
@@ -104,15 +105,15 @@ class PostsSerializer(serializers.ModelSerializer):
     count = serializers.SerializerMethodField()
 
     def get_comments(self, obj):
-        comments = Comment.objects.all_comments_for_post(obj.id, True)
-        foreign_comments = ForeignComment.objects.filter(parent_post=obj).order_by('-created_on')
+        # Comments are loaded for the whole page by prefetch_comments() in the api views.
+        comments = obj.comment_parent_post.all()
+        foreign_comments = obj.foreign_comment_parent_post.all()
         serializer = PostsCommentsSerializer(comments, many=True)
         foreign_serializer =  ForeignPostsCommentsSerializer(foreign_comments,many=True)
         return serializer.data + foreign_serializer.data
 
     def get_count(self, obj):
-        comments = Comment.objects.all_comments_for_post(obj.id, True)
-        return comments.count()
+        return len(obj.comment_parent_post.all())
 
     def validate_contentType(self, value):
         """
@@ -124,7 +125,7 @@ class PostsSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Post
-        exclude = ('created_on', 'imglink', 'markdown')
+        exclude = ('created_on', 'imglink', 'markdown', 'content_html', 'content_html_version')
 
 class AuthorSerializer(serializers.ModelSerializer):
     """
@@ -220,6 +221,37 @@ class FriendsQuerySerializer(serializers.Serializer):
             raise serializers.ValidationError("Author UUID is not valid.")
         return value
 
+class FriendshipsQuerySerializer(serializers.Serializer):
+    """
+    Serializer for the friend query which asks about many pairs of authors at once.
+    """
+    query = serializers.CharField(max_length=32, required=True)
+    pairs = serializers.ListField(child=serializers.ListField(child=serializers.CharField(max_length=36)))
+
+    def validate_query(self, value):
+        """
+        Check that the query is "friendships"
+        """
+        if value != "friendships":
+            raise serializers.ValidationError("Query type is not 'friendships'.")
+        return value
+
+    def validate_pairs(self, value):
+        """
+        Checks that there are at most FRIENDSHIPS_QUERY_MAX_PAIRS pairs of two valid uuids.
+        """
+        if len(value) > settings.FRIENDSHIPS_QUERY_MAX_PAIRS:
+            raise serializers.ValidationError("At most " + str(settings.FRIENDSHIPS_QUERY_MAX_PAIRS) + " pairs can be asked about at once.")
+        for pair in value:
+            if len(pair) != 2:
+                raise serializers.ValidationError("Each pair must have 2 author uuids.")
+            for author_id in pair:
+                try:
+                    uuid.UUID(author_id)
+                except ValueError:
+                    raise serializers.ValidationError("Author UUID is not valid.")
+        return value
+
 class FriendRequestSerializer(serializers.Serializer):
     query = serializers.CharField(max_length=32, required=True)
     author = FriendSerializerNoUrl(required=True)
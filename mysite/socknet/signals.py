@@ -1,6 +1,10 @@
+from django.db.models import Q
 from django.dispatch import receiver
-from django.db.models.signals import post_delete
-from socknet.models import Author, Node
+from django.db.models.signals import m2m_changed, pre_delete, post_delete, post_save
+from socknet.models import Author, ForeignAuthor, Node, Post, Comment, ForeignComment, ImageServ, ImageVariant
+from socknet.image_storage import get_image_storage
+from socknet.node_client import NodeClient
+from socknet.utils import FOAFCache, PostCache
 
 @receiver(post_delete, sender=Author)
 def post_delete_user(sender, instance, *args, **kwargs):
@@ -11,3 +15,115 @@ def post_delete_user(sender, instance, *args, **kwargs):
 def post_delete_user(sender, instance, *args, **kwargs):
     # When we delete a Node in django admin, also delete the user
     instance.foreignUserAccessAccount.delete()
+
+@receiver(post_delete, sender=Node)
+def close_node_session(sender, instance, *args, **kwargs):
+    # Don't keep connections open to a node we no longer talk to
+    NodeClient.forget(instance.pk)
+
+@receiver(post_save, sender=Post)
+@receiver(post_delete, sender=Post)
+def invalidate_post_cache(sender, instance, *args, **kwargs):
+    # The cached api document of the post is stale now
+    PostCache.invalidate(instance.id)
+
+@receiver(post_save, sender=Author)
+def invalidate_author_post_cache(sender, instance, created, *args, **kwargs):
+    # The author is embedded in the api documents of their posts and comments
+    if not created:
+        post_ids = Post.objects.filter(Q(author=instance) | Q(comment_parent_post__author=instance)).values_list('id', flat=True)
+        PostCache.invalidate_many(set(post_ids))
+
+@receiver(post_save, sender=ForeignAuthor)
+def invalidate_foreign_author_post_cache(sender, instance, created, *args, **kwargs):
+    # Foreign authors are embedded in the api documents of the posts they commented on
+    if not created:
+        PostCache.invalidate_many(set(instance.foreign_comment_author.values_list('parent_post_id', flat=True)))
+
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+@receiver(post_save, sender=ForeignComment)
+@receiver(post_delete, sender=ForeignComment)
+def invalidate_comment_post_cache(sender, instance, *args, **kwargs):
+    # Comments are embedded in their parent post's api document
+    PostCache.invalidate(instance.parent_post_id)
+
+@receiver(m2m_changed, sender=Author.friends.through)
+@receiver(m2m_changed, sender=Author.foreign_friends.through)
+def invalidate_foaf_cache(sender, instance, action, reverse, model, pk_set, *args, **kwargs):
+    # Cached FOAF answers involving either side of a changed friendship are stale now
+    if action == 'pre_clear':
+        # pk_set isn't sent for clear, look up who is about to be removed
+        if sender is Author.friends.through:
+            related = instance.friends.all()
+        elif reverse:
+            related = instance.my_foreign_friends.all()
+        else:
+            related = instance.foreign_friends.all()
+        pk_set = set(related.values_list('pk', flat=True))
+    elif action not in ('post_add', 'post_remove'):
+        return
+    # Local authors are known to other nodes by uuid, foreign authors by their id
+    author_ids = [instance.uuid if isinstance(instance, Author) else instance.pk]
+    if model is Author:
+        author_ids.extend(Author.objects.filter(pk__in=pk_set).values_list('uuid', flat=True))
+    else:
+        author_ids.extend(pk_set)
+    FOAFCache.invalidate(author_ids)
+
+# The relations that decide who has a pending friend request, with the attribute
+# to get them from either side.
+PENDING_FRIEND_REQUEST_RELATIONS = {
+    Author.friends.through: ('friends', 'friends'),
+    Author.who_im_following.through: ('who_im_following', 'my_followers'),
+    Author.ignored.through: ('ignored', 'ignored_by'),
+    Author.pending_foreign_friends.through: ('pending_foreign_friends', 'my_pending_foreign_friend_requests'),
+}
+
+def _update_pending_friend_request_counts(author_pks, instance=None):
+    counts = Author.objects.filter(pk__in=author_pks).update_pending_friend_request_counts()
+    if isinstance(instance, Author) and instance.pk in counts:
+        instance.pending_friend_request_count = counts[instance.pk]
+
+@receiver(m2m_changed, sender=Author.friends.through)
+@receiver(m2m_changed, sender=Author.who_im_following.through)
+@receiver(m2m_changed, sender=Author.ignored.through)
+@receiver(m2m_changed, sender=Author.pending_foreign_friends.through)
+def update_pending_friend_request_count(sender, instance, action, reverse, model, pk_set, *args, **kwargs):
+    # Recount for the authors on both sides of the change
+    if action == 'pre_clear':
+        # pk_set isn't sent for clear, remember who is about to be removed
+        forward, backward = PENDING_FRIEND_REQUEST_RELATIONS[sender]
+        instance._pending_cleared_pks = set(getattr(instance, backward if reverse else forward).values_list('pk', flat=True))
+        return
+    if action == 'post_clear':
+        pk_set = instance.__dict__.pop('_pending_cleared_pks', set())
+    elif action not in ('post_add', 'post_remove'):
+        return
+    author_pks = set(pk_set) if model is Author else set()
+    if isinstance(instance, Author):
+        author_pks.add(instance.pk)
+    _update_pending_friend_request_counts(author_pks, instance)
+
+@receiver(pre_delete, sender=Author)
+@receiver(pre_delete, sender=ForeignAuthor)
+def remember_pending_friend_requesters(sender, instance, *args, **kwargs):
+    # Deleting an author deletes their follows and friend requests without m2m_changed
+    if sender is Author:
+        instance._pending_affected_pks = list(instance.who_im_following.values_list('pk', flat=True))
+    else:
+        instance._pending_affected_pks = list(instance.my_pending_foreign_friend_requests.values_list('pk', flat=True))
+
+@receiver(post_delete, sender=Author)
+@receiver(post_delete, sender=ForeignAuthor)
+def update_pending_friend_request_count_after_delete(sender, instance, *args, **kwargs):
+    _update_pending_friend_request_counts(instance.__dict__.pop('_pending_affected_pks', []))
+
+@receiver(post_delete, sender=ImageServ)
+@receiver(post_delete, sender=ImageVariant)
+def delete_image_file(sender, instance, *args, **kwargs):
+    # Images are stored by content, only delete the bytes if no other image or variant has the same ones
+    digest = instance.image_hash
+    if digest and not ImageServ.objects.filter(image_hash=digest).exists() \
+            and not ImageVariant.objects.filter(image_hash=digest).exists():
+        get_image_storage().delete(digest)
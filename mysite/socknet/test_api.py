@@ -1,10 +1,17 @@
 from django.test import TestCase
+from django.db import connection
+from django.core.cache import cache
+from django.test.utils import CaptureQueriesContext
 from model_mommy import mommy
 from rest_framework.test import APITestCase, APIClient
 from socknet.models import *
 from socknet.serializers import *
+from socknet.authentication import credential_cache
+from socknet.friend_digest import FriendDigest
+from socknet.utils import PostCache
 import json
 import uuid
+import base64
 import datetime
 
 class FriendAPITests(APITestCase):
@@ -57,6 +64,66 @@ class FriendAPITests(APITestCase):
         response = self.client.get(url)
         self.assertEqual(response.status_code, 404)
 
+    def test_friendships_query(self):
+        """
+        POST http://service/friends/check/
+        """
+        self.author.foreign_friends.add(self.foreign_author)
+        self.author.friends.add(self.author2)
+        pairs = [[str(self.author.uuid), str(self.author2.uuid)], [str(self.author2.uuid), str(self.author.uuid)],
+            [str(self.foreign_author.id), str(self.author.uuid)], [str(self.author2.uuid), str(self.foreign_author.id)],
+            [str(self.uuid), str(self.uuid2)]]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post("/api/friends/check/", {"query": "friendships", "pairs": pairs}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(queries), 2)
+        decoded_json = json.loads(response.content)
+        self.assertEqual(decoded_json['query'], "friendships")
+        self.assertEqual([p['authors'] for p in decoded_json['pairs']], pairs)
+        self.assertEqual([p['friends'] for p in decoded_json['pairs']], [True, True, True, False, False])
+
+    def test_friendships_query_invalid(self):
+        """
+        POST http://service/friends/check/ with bad pairs or too many of them
+        """
+        url = "/api/friends/check/"
+        pair = [str(self.author.uuid), str(self.author2.uuid)]
+        response = self.client.post(url, {"query": "friendships", "pairs": [pair + pair]}, format='json')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(url, {"query": "friendships", "pairs": [[pair[0], "garbage"]]}, format='json')
+        self.assertEqual(response.status_code, 400)
+        with self.settings(FRIENDSHIPS_QUERY_MAX_PAIRS=2):
+            response = self.client.post(url, {"query": "friendships", "pairs": [pair] * 3}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_friends_digest(self):
+        """
+        GET http://service/friends/<authorid>/digest/
+        """
+        self.author.foreign_friends.add(self.foreign_author)
+        self.author.friends.add(self.author2)
+        url = "/api/friends/%s/digest/" % self.author.uuid
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        decoded_json = json.loads(response.content)
+        self.assertEqual(decoded_json['query'], "friendsdigest")
+        self.assertEqual(decoded_json['count'], 2)
+        digest = FriendDigest.from_dict(decoded_json)
+        self.assertTrue(digest.might_contain(self.author2.uuid))
+        self.assertTrue(digest.might_contain(str(self.foreign_author.id).upper()))
+
+        # Unchanged
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        # Changed
+        self.author.friends.remove(self.author2)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(FriendDigest.from_dict(json.loads(response.content)).might_contain(self.author2.uuid))
+
+        response = self.client.get("/api/friends/%s/digest/" % self.uuid)
+        self.assertEqual(response.status_code, 404)
+
     def test_friends_query(self):
         """
         GET http://service/friends/<authorid>
@@ -189,6 +256,8 @@ class FriendAPITests(APITestCase):
 
 class PostsAPITests(APITestCase):
     def setUp(self):
+        # Serialized posts are cached between requests
+        cache.clear()
         self.client = APIClient(HTTP_HOST='127.0.0.1:8000')
 
         self.user = mommy.make(User)
@@ -217,6 +286,160 @@ class PostsAPITests(APITestCase):
         self.assertEqual(decoded_json['posts'][0]['visibility'], "PUBLIC", "Post visibility does not match.")
         self.assertEqual(decoded_json['posts'][0]['categories'], "N/A", "Post categories does not match.")
 
+    def _count_queries(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
+
+    def test_posts_comment_queries_fixed(self):
+        """
+        GET http://service/posts
+        The number of queries should not grow with the number of posts or comments.
+        """
+        node = mommy.make(Node, name="Test Node", url="http://test-node.com")
+        foreign_author = mommy.make(ForeignAuthor, node=node)
+
+        def make_post():
+            post = mommy.make(Post, author=self.author, markdown=False)
+            mommy.make(Comment, parent_post=post, author=self.author, markdown=False, _quantity=2)
+            mommy.make(ForeignComment, parent_post=post, foreign_author=foreign_author, markdown=False)
+            return post
+
+        make_post()
+        few_posts = self._count_queries("/api/posts/")
+        for i in range(5):
+            make_post()
+        many_posts = self._count_queries("/api/posts/")
+        self.assertEqual(few_posts, many_posts, "Query count grew with the number of posts.")
+
+        response = self.client.get("/api/posts/")
+        decoded_json = json.loads(response.content)
+        self.assertEqual(len(decoded_json['posts']), 6)
+        self.assertEqual(len(decoded_json['posts'][0]['comments']), 3, "Local and foreign comments should be included.")
+        self.assertEqual(decoded_json['posts'][0]['count'], 2, "Count should be the number of local comments.")
+
+    def test_posts_cache(self):
+        """
+        GET http://service/posts
+        Cached posts are reused until the post or one of its comments is saved.
+        """
+        post = mommy.make(Post, author=self.author, title="Example Title", markdown=False)
+        first = self._count_queries("/api/posts/")
+        second = self._count_queries("/api/posts/")
+        self.assertTrue(second < first, "Cached posts should not be serialized again.")
+
+        # Adding a comment invalidates the post
+        mommy.make(Comment, parent_post=post, author=self.author, content="Example Comment", markdown=False)
+        decoded_json = json.loads(self.client.get("/api/posts/").content)
+        self.assertEqual(decoded_json['posts'][0]['comments'][0]['comment'], "Example Comment")
+
+        # So does editing the post
+        post.title = "New Title"
+        post.save()
+        decoded_json = json.loads(self.client.get("/api/posts/").content)
+        self.assertEqual(decoded_json['posts'][0]['title'], "New Title")
+
+        # And editing the author's profile
+        self.author.displayName = "New Name"
+        self.author.save()
+        decoded_json = json.loads(self.client.get("/api/posts/").content)
+        self.assertEqual(decoded_json['posts'][0]['author']['displayName'], "New Name")
+
+        # A document built before an invalidation isn't cached under the new version
+        cached, versions = PostCache.get_many([post.id], "http://stale")
+        PostCache.invalidate(post.id)
+        PostCache.set_many({post.id: "stale"}, "http://stale", versions)
+        self.assertEqual(PostCache.get_many([post.id], "http://stale")[0], {})
+
+        # Posts are cached per host
+        other_host = APIClient(HTTP_HOST='localhost:8000')
+        other_host.force_authenticate(user=self.user)
+        decoded_json = json.loads(other_host.get("/api/posts/").content)
+        self.assertEqual(decoded_json['posts'][0]['origin'], "http://localhost:8000/posts/" + str(post.id))
+
+    def test_posts_conditional_get(self):
+        """
+        GET http://service/posts with If-None-Match
+        """
+        post = mommy.make(Post, author=self.author, markdown=False)
+        response = self.client.get("/api/posts/")
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        # It could move back when the newest post is deleted
+        self.assertFalse(response.has_header('Last-Modified'))
+
+        response = self.client.get("/api/posts/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # A new comment changes the post
+        mommy.make(Comment, parent_post=post, author=self.author, markdown=False)
+        response = self.client.get("/api/posts/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+        # So does editing its author
+        etag = response['ETag']
+        self.author.displayName = "New Name"
+        self.author.save()
+        response = self.client.get("/api/posts/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['posts'][0]['author']['displayName'], "New Name")
+
+    def test_post_and_comments_conditional_get(self):
+        """
+        GET http://service/posts/{POST_ID} and http://service/posts/{POST_ID}/comments with If-None-Match
+        """
+        post = mommy.make(Post, author=self.author, markdown=False)
+        for url in ("/api/posts/%s/" % post.id, "/api/posts/%s/comments/" % post.id):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(response.status_code, 304)
+
+    def test_posts_cursor(self):
+        """
+        GET http://service/posts?cursor=
+        Following the next links should visit every post once, newest first.
+        """
+        for i in range(5):
+            mommy.make(Post, author=self.author, markdown=False)
+        expected = [str(post.id) for post in Post.objects.order_by('-created_on', '-id')]
+
+        seen = []
+        url = "/api/posts/?cursor=&size=2"
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            decoded_json = json.loads(response.content)
+            self.assertFalse('count' in decoded_json, "Cursor pages should not have a count.")
+            self.assertFalse('previous' in decoded_json)
+            seen += [post['id'] for post in decoded_json['posts']]
+            url = decoded_json.get('next')
+        self.assertEqual(seen, expected)
+
+    def test_posts_cursor_invalid(self):
+        """
+        GET http://service/posts?cursor=<garbage>
+        """
+        response = self.client.get("/api/posts/?cursor=garbage")
+        self.assertEqual(response.status_code, 404)
+
+    def test_posts_page_number(self):
+        """
+        GET http://service/posts?page=2
+        Nodes that don't send a cursor still get page numbers and a count.
+        """
+        for i in range(3):
+            mommy.make(Post, author=self.author, markdown=False)
+        response = self.client.get("/api/posts/?page=2&size=2")
+        decoded_json = json.loads(response.content)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(decoded_json['count'], 3)
+        self.assertEqual(len(decoded_json['posts']), 1)
+        self.assertTrue('previous' in decoded_json)
+        self.assertFalse('next' in decoded_json)
+
     def test_author_posts(self):
         """
         GET http://service/author/posts
@@ -521,3 +744,46 @@ class CommentAPITests(APITestCase):
         self.assertEqual(decoded_json['query'], "addComment", "Query was incorrect")
         self.assertEqual(decoded_json['message'], "Comment not allowed", "Message was incorrect")
         self.assertFalse(decoded_json['success'], "Success should have been false.")
+
+class NodeAuthenticationTests(APITestCase):
+    def setUp(self):
+        credential_cache.clear()
+        self.client = APIClient()
+        self.node_user = User.objects.create_user(username="node", password="nodepass")
+        self.node = mommy.make(Node, name="Test Node", url="http://test-node.com", foreignUserAccessAccount=self.node_user)
+        self.author_user = User.objects.create_user(username="author", password="authorpass")
+        self.author = mommy.make(Author, user=self.author_user)
+        self.url = "/api/friends/%s/" % self.author.uuid
+
+    def _get(self, username, password):
+        credentials = base64.b64encode(username + ":" + password)
+        return self.client.get(self.url, HTTP_AUTHORIZATION="Basic " + credentials)
+
+    def test_node_credentials_cached(self):
+        """
+        A node's credentials are remembered after the first successful check.
+        """
+        self.assertEqual(self._get("node", "nodepass").status_code, 200)
+        self.assertEqual(len(credential_cache.entries), 1)
+        self.assertEqual(self._get("node", "nodepass").status_code, 200)
+        # Wrong passwords are never cached
+        self.assertEqual(self._get("node", "wrong").status_code, 401)
+        self.assertEqual(len(credential_cache.entries), 1)
+
+    def test_password_change_invalidates(self):
+        """
+        Changing a node's password stops the old credentials from working.
+        """
+        self.assertEqual(self._get("node", "nodepass").status_code, 200)
+        self.node_user.set_password("newpass")
+        self.node_user.save()
+        self.assertEqual(self._get("node", "nodepass").status_code, 401)
+        self.assertEqual(len(credential_cache.entries), 0)
+        self.assertEqual(self._get("node", "newpass").status_code, 200)
+
+    def test_other_users_not_cached(self):
+        """
+        Only node accounts are cached.
+        """
+        self.assertEqual(self._get("author", "authorpass").status_code, 200)
+        self.assertEqual(len(credential_cache.entries), 0)
@@ -6,7 +6,17 @@ from __future__ import unicode_literals
 from model_mommy import mommy
 from django.test import TestCase
 from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.utils.six import StringIO
+from django.test import override_settings
+from django.utils import timezone
+import shutil
+import tempfile
+import time
+from datetime import timedelta
+from io import BytesIO
 
+from PIL import Image
 from socknet.models import *
 from socknet.forms import *
 
@@ -58,6 +68,394 @@ class PostsTests(TestCase):
         self._is_markdown(model)
         self._accepts_weird_characters(model)
 
+class RenderedContentTests(TestCase):
+    def setUp(self):
+        self.author = mommy.make(Author, user=mommy.make(User))
+
+    def test_rendered_on_save(self):
+        post = mommy.make(Post, author=self.author, content='# testing', markdown=True)
+        self.assertEqual(post.content_html, '<h1>testing</h1><br/>')
+        self.assertEqual(post.content_html_version, HTMLsafe.RENDERER_VERSION)
+        self.assertEqual(Post.objects.get(id=post.id).view_content(), '<h1>testing</h1><br/>')
+
+    def test_rendered_on_update_fields(self):
+        post = mommy.make(Post, author=self.author, content='testing', markdown=False)
+        post.content = post.content + '\n<b>'
+        post.save(update_fields=['content'])
+        self.assertEqual(Post.objects.get(id=post.id).content_html, 'testing<br/>&lt;b&gt;')
+
+    def test_backfill(self):
+        post = mommy.make(Post, author=self.author, content='# testing', markdown=True)
+        comment = mommy.make(Comment, parent_post=post, author=self.author, content='<b>', markdown=False)
+        # Pretend the rows were saved before content_html existed
+        Post.objects.update(content_html='', content_html_version=0)
+        Comment.objects.update(content_html='', content_html_version=0)
+        call_command('backfill_content_html', batch_size=1, stdout=StringIO())
+        post = Post.objects.get(id=post.id)
+        self.assertEqual(post.content_html, '<h1>testing</h1><br/>')
+        self.assertEqual(post.content_html_version, HTMLsafe.RENDERER_VERSION)
+        self.assertEqual(Comment.objects.get(id=comment.id).content_html, '&lt;b&gt;')
+
+class ImageTests(TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.settings_override = override_settings(IMAGE_STORAGE_OPTIONS={'location': self.location})
+        self.settings_override.enable()
+        self.author = mommy.make(Author, user=mommy.make(User))
+        self.post = mommy.make(Post, author=self.author, markdown=False)
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.location)
+
+    def test_create_image(self):
+        image = ImageServ.objects.create_image(b'image bytes', self.author, self.post, 'image/png')
+        self.assertEqual(image.image_hash, get_image_storage().digest(b'image bytes'))
+        self.assertTrue(get_image_storage().exists(image.image_hash))
+        self.assertEqual(ImageServ.objects.get(id=image.id).read_image(), b'image bytes')
+
+    def test_same_bytes_stored_once(self):
+        image1 = ImageServ.objects.create_image(b'image bytes', self.author, self.post, 'image/png')
+        image2 = ImageServ.objects.create_image(b'image bytes', self.author, self.post, 'image/png')
+        self.assertEqual(image1.image_hash, image2.image_hash)
+        # The bytes stay until the last image using them is deleted
+        image1.delete()
+        self.assertTrue(get_image_storage().exists(image2.image_hash))
+        image2.delete()
+        self.assertFalse(get_image_storage().exists(image2.image_hash))
+
+    def test_raw_image_serve(self):
+        image = ImageServ.objects.create_image(b'image bytes', self.author, self.post, 'image/png')
+        response = self.client.get('/media/%s' % image.id)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertEqual(response['Content-Length'], str(len(b'image bytes')))
+        self.assertEqual(b''.join(response.streaming_content), b'image bytes')
+        self.assertEqual(response['ETag'], '"%s"' % image.image_hash)
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+        # The browser already has it
+        response = self.client.get('/media/%s' % image.id, HTTP_IF_NONE_MATCH='"%s"' % image.image_hash)
+        self.assertEqual(response.status_code, 304)
+
+    def test_raw_image_serve_range(self):
+        image = ImageServ.objects.create_image(b'image bytes', self.author, self.post, 'image/png')
+        url = '/media/%s' % image.id
+        for header, expected, content_range in [('bytes=0-4', b'image', 'bytes 0-4/11'),
+                ('bytes=6-', b'bytes', 'bytes 6-10/11'),
+                ('bytes=-5', b'bytes', 'bytes 6-10/11'),
+                ('bytes=6-100', b'bytes', 'bytes 6-10/11')]:
+            response = self.client.get(url, HTTP_RANGE=header)
+            self.assertEqual(response.status_code, 206, header)
+            self.assertEqual(response['Content-Range'], content_range)
+            self.assertEqual(response['Content-Length'], str(len(expected)))
+            self.assertEqual(b''.join(response.streaming_content), expected)
+
+        response = self.client.get(url, HTTP_RANGE='bytes=11-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */11')
+
+        # Malformed, several ranges or a stale If-Range get the whole image
+        for extra in [{'HTTP_RANGE': 'bytes=4-2'}, {'HTTP_RANGE': 'bytes=0-1,4-5'},
+                {'HTTP_RANGE': 'bytes=0-4', 'HTTP_IF_RANGE': '"stale"'}]:
+            response = self.client.get(url, **extra)
+            self.assertEqual(response.status_code, 200, extra)
+            self.assertEqual(b''.join(response.streaming_content), b'image bytes')
+
+    def _make_png(self, size, mode='RGB'):
+        output = BytesIO()
+        Image.new(mode, size).save(output, 'PNG')
+        return output.getvalue()
+
+    def test_variants(self):
+        image = ImageServ.objects.create_image(self._make_png((800, 600)), self.author, self.post, 'image/png')
+        response = self.client.get('/media/%s?size=thumb' % image.id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        thumb = Image.open(BytesIO(b''.join(response.streaming_content)))
+        self.assertEqual(thumb.size, (200, 150))
+        # Made once, then reused
+        self.assertEqual(image.variants.count(), 1)
+        self.client.get('/media/%s?size=thumb' % image.id)
+        self.assertEqual(image.variants.count(), 1)
+
+        # Already fits the display size, served as is
+        display = image.get_variant('display')
+        self.assertEqual(display.image_hash, image.image_hash)
+        self.assertEqual(display.imagetype, 'image/png')
+
+        self.assertEqual(self.client.get('/media/%s?size=huge' % image.id).status_code, 400)
+
+        # Transparency is kept
+        transparent = ImageServ.objects.create_image(self._make_png((400, 400), 'RGBA'), self.author, self.post, 'image/png')
+        self.assertEqual(transparent.get_variant('thumb').imagetype, 'image/png')
+
+        thumb_hash = image.get_variant('thumb').image_hash
+        image.delete()
+        self.assertFalse(get_image_storage().exists(thumb_hash))
+        self.assertFalse(get_image_storage().exists(image.image_hash))
+
+    def test_move_images_to_storage(self):
+        # Images saved before the image storage existed
+        legacy = [ImageServ.objects.create(image=b'legacy %d' % i, author=self.author, parent_post=self.post, imagetype='image/png')
+            for i in range(3)]
+        self.assertEqual(ImageServ.objects.get(id=legacy[0].id).read_image(), b'legacy 0')
+        call_command('move_images_to_storage', batch_size=2, stdout=StringIO())
+        for i, image in enumerate(legacy):
+            image = ImageServ.objects.get(id=image.id)
+            self.assertTrue(image.image_hash)
+            self.assertEqual(bytes(image.image), b'')
+            self.assertEqual(image.read_image(), b'legacy %d' % i)
+
+class ForeignPostTests(TestCase):
+    def setUp(self):
+        self.node = mommy.make(Node, name="Test Node", url="http://127.0.0.1:1/api/")
+
+    def _post_json(self, post_id, **fields):
+        post = {
+            'id': post_id,
+            'title': 'A remote post',
+            'description': 'description',
+            'content': '# remote',
+            'contentType': 'text/markdown',
+            'visibility': 'PUBLIC',
+            'published': '2016-11-20T10:00:00Z',
+            'author': {'id': 'a1b2', 'host': 'http://127.0.0.1:1/api/', 'displayName': 'Joe',
+                'url': 'http://remote-node.com/author/a1b2', 'github': ''},
+            'comments': [{'id': 'c1', 'comment': 'nice', 'contentType': 'text/plain', 'published': '2016-11-20T11:00:00Z',
+                'author': {'id': 'a3', 'host': 'http://127.0.0.1:1/api/', 'displayName': 'Ann'}}],
+        }
+        post.update(fields)
+        return post
+
+    def test_store_posts(self):
+        from socknet.federation import store_posts
+        posts = [self._post_json('0a1'), self._post_json('0a2', published='2016-11-21T10:00:00Z'),
+            self._post_json('bad', contentType='application/pdf')]
+        self.assertEqual(store_posts(self.node, posts, listed=True), 2)
+        self.assertEqual(ForeignPost.objects.count(), 2)
+        post = ForeignPost.objects.get(node=self.node, post_id='0a1')
+        self.assertEqual(post.view_content(), '<h1>remote</h1><br/>')
+        self.assertEqual(post.author_display_name, 'Joe')
+        self.assertEqual([c.content for c in post.get_comments()], ['nice'])
+
+        # Nothing changed, nothing written
+        self.assertEqual(store_posts(self.node, posts, listed=True), 0)
+        # Upserted by (node, post id)
+        self.assertEqual(store_posts(self.node, [self._post_json('0a1', title='Edited')], listed=False), 1)
+        post = ForeignPost.objects.get(node=self.node, post_id='0a1')
+        self.assertEqual(post.title, 'Edited')
+        self.assertTrue(post.listed)
+        self.assertEqual(ForeignPost.objects.count(), 2)
+
+    def test_list_remote_posts(self):
+        from socknet.federation import store_posts
+        store_posts(self.node, [self._post_json('0a1'), self._post_json('0a2', published='2016-11-21T10:00:00Z')], listed=True)
+        # Fetched on its own, not in the node's list
+        store_posts(self.node, [self._post_json('0a3')], listed=False)
+        user = mommy.make(User)
+        mommy.make(Author, user=user)
+        self.client.force_login(user)
+        response = self.client.get('/remote_posts/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([p.post_id for p in response.context['posts_list']], ['0a2', '0a1'])
+
+        response = self.client.get('/remote_node/%d/remote_posts/0a1/' % self.node.id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['postdat'].post_id, '0a1')
+        self.assertEqual(response.context['num_comments'], 1)
+
+    def test_sync_records_failure(self):
+        from socknet.federation import sync_node_posts
+        # Nothing listens on port 1
+        with self.assertRaises(Exception):
+            sync_node_posts(self.node)
+        node = Node.objects.get(id=self.node.id)
+        self.assertTrue(node.posts_sync_error)
+        self.assertIsNone(node.posts_synced_on)
+
+class FriendsPostsTests(TestCase):
+    def setUp(self):
+        self.user = mommy.make(User)
+        self.author = mommy.make(Author, user=self.user)
+        self.client.force_login(self.user)
+
+    def test_local_friends_posts(self):
+        friends = [mommy.make(Author, user=mommy.make(User)) for i in range(3)]
+        stranger = mommy.make(Author, user=mommy.make(User))
+        for friend in friends:
+            self.author.friends.add(friend)
+            mommy.make(Post, author=friend, visibility='PUBLIC', markdown=False)
+            mommy.make(Post, author=friend, visibility='PRIVATE', markdown=False)
+        mommy.make(Post, author=stranger, visibility='PUBLIC', markdown=False)
+
+        response = self.client.get('/friends_posts/')
+        self.assertEqual(response.status_code, 200)
+        posts = response.context['posts_list']
+        self.assertEqual(len(posts), 3)
+        self.assertEqual(set(post.author_id for post in posts), set(friend.uuid for friend in friends))
+
+    def test_unavailable_node_skipped(self):
+        # Nothing listens on port 1, and the circuit is open so it isn't even tried
+        node = mommy.make(Node, name="Down Node", url="http://127.0.0.1:1/api/",
+            circuit_open_until=timezone.now() + timedelta(minutes=1))
+        for i in range(3):
+            self.author.foreign_friends.add(mommy.make(ForeignAuthor, node=node))
+        response = self.client.get('/friends_posts/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['unavailable_nodes'], ['Down Node'])
+        self.assertEqual(Node.objects.get(id=node.id).consecutive_failures, 0)
+
+class RemoteProfileTests(TestCase):
+    def setUp(self):
+        self.user = mommy.make(User)
+        self.author = mommy.make(Author, user=self.user)
+        self.client.force_login(self.user)
+
+    def test_unavailable_node(self):
+        # The profile and posts calls fail right away, the page still renders
+        node = mommy.make(Node, name="Down Node", url="http://127.0.0.1:1/api/",
+            circuit_open_until=timezone.now() + timedelta(minutes=1))
+        remote = mommy.make(ForeignAuthor, node=node)
+        start = time.time()
+        response = self.client.get('/remote_node/' + str(node.id) + '/remote_profile/' + str(remote.id) + '/')
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("Down Node", response.context['error'])
+        self.assertIn("Down Node", response.context['posts_error'])
+        self.assertNotIn('posts', response.context)
+        self.assertEqual(Node.objects.get(id=node.id).consecutive_failures, 0)
+
+class FOAFQueryTests(TestCase):
+    def setUp(self):
+        self.viewer, self.friend, self.foaf, self.foreign_foaf, self.stranger = [mommy.make(Author, user=mommy.make(User)) for i in range(5)]
+        self.foreign_author = mommy.make(ForeignAuthor, node=mommy.make(Node, name="Test Node"))
+        self.viewer.friends.add(self.friend)
+        self.foaf.friends.add(self.friend)
+        self.viewer.foreign_friends.add(self.foreign_author)
+        self.foreign_foaf.foreign_friends.add(self.foreign_author)
+        self.stranger.foreign_friends.add(mommy.make(ForeignAuthor, node=self.foreign_author.node))
+
+    def test_is_FOAF_local(self):
+        with self.assertNumQueries(1):
+            self.assertTrue(is_FOAF_local(self.viewer, self.foaf))
+        self.assertTrue(is_FOAF_local(self.viewer, self.foreign_foaf))
+        self.assertFalse(is_FOAF_local(self.viewer, self.stranger))
+        # Being friends doesn't make them a FOAF
+        self.assertFalse(is_FOAF_local(self.viewer, self.friend))
+
+    def test_FOAF_of_many(self):
+        authors = Author.objects.exclude(pk=self.viewer.pk)
+        with self.assertNumQueries(1):
+            foafs = set(authors.FOAF_of(self.viewer))
+        self.assertEqual(foafs, set([self.foaf, self.foreign_foaf]))
+        self.assertEqual(list(Author.objects.filter(pk=self.viewer.pk).FOAF_of(self.foaf)), [self.viewer])
+
+class PendingFriendRequestCountTests(TestCase):
+    def setUp(self):
+        self.author, self.other, self.third = [mommy.make(Author, user=mommy.make(User)) for i in range(3)]
+        self.foreign_author = mommy.make(ForeignAuthor, node=mommy.make(Node, name="Test Node"))
+
+    def _count(self, author):
+        count = Author.objects.get(pk=author.pk).pending_friend_request_count
+        self.assertEqual(count, len(author.get_pending_friend_requests()))
+        return count
+
+    def test_count_kept(self):
+        self.other.follow(self.author)
+        self.third.follow(self.author)
+        self.assertEqual(self._count(self.author), 2)
+        self.author.decline_friend_request(self.third.uuid, True)
+        self.assertEqual(self._count(self.author), 1)
+        self.author.accept_friend_request(self.other.uuid, True)
+        self.assertEqual(self.author.get_pending_friend_request_count(), 0)
+        self.assertEqual(self._count(self.author), 0)
+        self.assertEqual(self._count(self.other), 0)
+
+        self.author.pending_foreign_friends.add(self.foreign_author)
+        self.assertEqual(self._count(self.author), 1)
+        self.author.accept_friend_request(self.foreign_author.id, False)
+        self.assertEqual(self._count(self.author), 0)
+
+        # Unfriended, they still follow us
+        self.author.delete_friend(self.other, True)
+        self.assertEqual(self._count(self.author), 1)
+        self.other.who_im_following.clear()
+        self.assertEqual(self._count(self.author), 0)
+
+        self.author.pending_foreign_friends.add(self.foreign_author)
+        fourth = mommy.make(Author, user=mommy.make(User))
+        fourth.follow(self.author)
+        self.assertEqual(self._count(self.author), 2)
+        fourth.delete()
+        self.foreign_author.delete()
+        self.assertEqual(self._count(self.author), 0)
+
+    def test_recount_queries_fixed(self):
+        followers = [mommy.make(Author, user=mommy.make(User)) for i in range(5)]
+        for follower in followers:
+            follower.follow(self.author)
+        self.author.ignored.add(followers[0])
+        with self.assertNumQueries(2):
+            counts = Author.objects.all().update_pending_friend_request_counts()
+        self.assertEqual(counts[self.author.pk], 4)
+        self.assertEqual(self._count(self.author), 4)
+        self.assertEqual(counts[followers[0].pk], 0)
+
+    def test_save_keeps_count(self):
+        stale = Author.objects.get(pk=self.author.pk)
+        self.other.follow(self.author)
+        stale.about_me = 'changed'
+        stale.save()
+        author = Author.objects.get(pk=self.author.pk)
+        self.assertEqual(author.about_me, 'changed')
+        self.assertEqual(author.pending_friend_request_count, 1)
+
+    def test_navbar(self):
+        self.other.follow(self.author)
+        self.client.force_login(self.author.user)
+        response = self.client.get('/friends_posts/')
+        self.assertEqual(response.context['pending_friend_request_count'], 1)
+        self.assertContains(response, '<span id="fr-label" class="navbar-fr-label badge">1</span>', html=True)
+
+class ForeignFriendCheckTests(TestCase):
+    def setUp(self):
+        self.user = mommy.make(User)
+        self.author = mommy.make(Author, user=self.user)
+        # Nothing listens on port 1
+        self.node = mommy.make(Node, name="Down Node", url="http://127.0.0.1:1/api/")
+        self.friend = mommy.make(ForeignAuthor, node=self.node)
+        self.requested = mommy.make(ForeignAuthor, node=self.node)
+        self.author.foreign_friends.add(self.friend)
+        self.author.foreign_friends_im_following.add(self.requested)
+
+    def test_friendships_to_check(self):
+        from socknet.federation import get_friendships_to_check
+        pairs = [(self.author.id, self.friend.id), (self.author.id, self.requested.id)]
+        self.assertEqual(set(get_friendships_to_check(10)), set(pairs))
+        # Checked a while ago goes after never checked, checked recently isn't due
+        ForeignFriendCheck.objects.create(author=self.author, foreign_author=self.friend,
+            last_checked=timezone.now() - timedelta(days=1))
+        self.assertEqual(get_friendships_to_check(10), [pairs[1], pairs[0]])
+        self.assertEqual(get_friendships_to_check(1), [pairs[1]])
+        ForeignFriendCheck.objects.create(author=self.author, foreign_author=self.requested, last_checked=timezone.now())
+        self.assertEqual(get_friendships_to_check(10), [pairs[0]])
+
+    def test_unreachable_node_not_marked_checked(self):
+        from socknet.federation import reconcile_node_friendships
+        self.assertEqual(reconcile_node_friendships([(self.author, self.friend), (self.author, self.requested)]), 0)
+        self.assertFalse(ForeignFriendCheck.objects.exists())
+        # Nothing changes without an answer
+        self.assertEqual(list(self.author.foreign_friends.all()), [self.friend])
+
+    def test_manage_friends_doesnt_call_nodes(self):
+        self.client.force_login(self.user)
+        response = self.client.get('/friends/%s/' % self.author.uuid)
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(Node.objects.get(id=self.node.id).last_failure_on)
+
 class AuthorTests(TestCase):
     def setUp(self):
         # Create local authors
@@ -0,0 +1,439 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import random
+import threading
+import time
+import BaseHTTPServer
+import json
+import uuid
+import SocketServer
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from model_mommy import mommy
+
+from socknet.models import Author, ForeignAuthor, ForeignPost, Node, CachedResponse, ForeignFriendCheck
+from socknet.node_client import NodeClient, NodeUnavailable
+from socknet.feed_parser import PostFeed, FeedError
+from socknet.friend_digest import FriendDigest
+from socknet.federation import iter_node_posts, reconcile_node_friendships, store_posts, sync_node_posts
+from socknet.utils import HTMLsafe, FOAFCache, call_concurrently, is_FOAF_remote
+from socknet.management.commands.bench_markdown import legacy_unescape_markdown, render, sample_post, sample_code_block
+
+class UnescapeMarkdownTests(SimpleTestCase):
+    """
+    HTMLsafe._unescape_markdown has to give exactly what the previous implementation gave.
+    """
+
+    def _assert_parity(self, text):
+        self.assertEqual(HTMLsafe._unescape_markdown(text), legacy_unescape_markdown(text), repr(text))
+
+    def test_handwritten(self):
+        corpus = [
+            '',
+            'no tags at all &amp; stuff',
+            '<p>&lt;b&gt; outside code</p>',
+            '<p><code>a &lt; b &amp;&amp; c</code></p>',
+            '<pre><code>if (x &lt; 1) {\n  &quot;s&quot;;\n}\n</code></pre>',
+            '<code>unclosed &amp; still decoded',
+            '</code>closed first &amp;<code>then &amp; open',
+            '<code><code>nested &amp;</code> still inside &amp;</code> out &amp;',
+            '< code >spaced &amp;< / code > out &amp;',
+            '<c o d e>spaced inside &amp;</c ode>',
+            '<coder>not code &amp;</coder>',
+            '<codex>&amp;',
+            'code>at the start &amp;<p>&amp;</p>',
+            '/code>at the start &amp;',
+            '<code>&#60;&#x3C;&#X3c;&apos;&bogus;&#1114111;&#;&amp</code>',
+            '<code>\t&amp;</code><\tcode>&amp;',
+            '<code>( ͡° ͜ʖ ͡°) &amp; ¯\\_ツ_/¯</code>',
+            '<<code>>&amp;<</code>&amp;',
+        ]
+        for text in corpus:
+            self._assert_parity(text)
+
+    def test_rendered_markdown(self):
+        corpus = [
+            '# testing\n<b>\n>test-block',
+            'Inline `a < b && c > d` and `<br/>`',
+            '```\n<html> & "quotes"\n```',
+            '    indented <code> & block\n\ntext &amp; after',
+            '> quote `&lt;` in code',
+            sample_post(),
+            sample_code_block(),
+        ]
+        for markdown_text in corpus:
+            self._assert_parity(render(markdown_text))
+
+    def test_random(self):
+        pieces = ['<', '>', 'code>', '/code>', '<code>', '</code>', '< code>', '</ code >',
+            ' ', 'a', '\n', '&', '&amp;', '&lt;', '&#60;', '&#x3c;', '&nbsp;', '&bogus;', 'ツ']
+        generator = random.Random(404)
+        for i in range(2000):
+            text = ''.join(generator.choice(pieces) for j in range(generator.randint(0, 30)))
+            self._assert_parity(text)
+
+class CallConcurrentlyTests(SimpleTestCase):
+
+    def _work(self, item):
+        if item == 'fail':
+            raise ValueError("Response code was bad: 500")
+        time.sleep(item)
+        return item * 2
+
+    def test_results_and_failures(self):
+        results, failures = call_concurrently(self._work, [0.2, 'fail', 0, 0.2], 5)
+        self.assertEqual(results, [(0.2, 0.4), (0, 0), (0.2, 0.4)])
+        self.assertEqual(failures, [('fail', "Response code was bad: 500")])
+
+    def test_runs_concurrently(self):
+        start = time.time()
+        results, failures = call_concurrently(self._work, [0.3] * 4, 5)
+        self.assertEqual(len(results), 4)
+        self.assertLess(time.time() - start, 1.0)
+
+    def test_deadline(self):
+        start = time.time()
+        results, failures = call_concurrently(self._work, [0, 2, 0], 0.3)
+        self.assertLess(time.time() - start, 1.0)
+        self.assertEqual(results, [(0, 0), (0, 0)])
+        self.assertEqual([item for item, reason in failures], [2])
+        self.assertIn("No response", failures[0][1])
+
+    def test_no_items(self):
+        self.assertEqual(call_concurrently(self._work, [], 1), ([], []))
+
+class PostFeedTests(SimpleTestCase):
+
+    def _chunks(self, text, size):
+        data = text.encode('utf-8')
+        return [data[i:i + size] for i in range(0, len(data), size)]
+
+    def test_chunked(self):
+        posts = [{'id': str(i), 'title': 'Post ツ ' + str(i), 'count': 12345, 'comments': [{'comment': '[]{},"'}]} for i in range(5)]
+        text = json.dumps({'query': 'posts', 'count': 5, 'posts': posts, 'next': 'http://a/api/posts?page=2'}, ensure_ascii=False)
+        for size in (1, 2, 7, 64, len(text) * 4):
+            feed = PostFeed(self._chunks(text, size), 10 ** 6)
+            self.assertEqual(list(feed), posts)
+            self.assertEqual(feed.fields, {'query': 'posts', 'count': 5, 'next': 'http://a/api/posts?page=2'})
+
+    def test_single_post_and_empty(self):
+        self.assertEqual(list(PostFeed(self._chunks('{"posts": {"id": "1"}}', 3), 100)), [{'id': '1'}])
+        self.assertEqual(list(PostFeed(self._chunks(' { "posts" : [ ] } ', 3), 100)), [])
+        self.assertEqual(list(PostFeed(self._chunks('{}', 3), 100)), [])
+
+    def test_too_large(self):
+        text = json.dumps({'posts': [{'id': str(i)} for i in range(100)]})
+        feed = iter(PostFeed(self._chunks(text, 10), 200))
+        with self.assertRaises(FeedError):
+            for post in feed:
+                pass
+        # Posts are read one at a time, so the ones before the limit were given
+        self.assertLess(int(post['id']), 20)
+
+    def test_invalid(self):
+        for text in ('', '[]', '{"posts": [{"id": 1}', '{"posts": [{"id": 1}}', '{"posts": 12'):
+            with self.assertRaises(FeedError):
+                list(PostFeed(self._chunks(text, 4), 100))
+
+class FriendDigestTests(SimpleTestCase):
+
+    def test_false_positive_rate(self):
+        friends = [uuid.uuid4() for i in range(500)]
+        digest = FriendDigest.build(friends, 0.01)
+        self.assertTrue(all(digest.might_contain(friend) for friend in friends))
+        false_positives = sum(digest.might_contain(uuid.uuid4()) for i in range(10000))
+        self.assertLess(false_positives, 200)
+
+    def test_false_positive_rate_few_friends(self):
+        # Most authors have a handful of friends, the filters are smallest there
+        for count in range(1, 11):
+            false_positives = 0
+            for i in range(100):
+                digest = FriendDigest.build([uuid.uuid4() for j in range(count)], 0.01)
+                false_positives += sum(digest.might_contain(uuid.uuid4()) for j in range(200))
+            self.assertLess(false_positives / 20000.0, 0.01, count)
+
+    def test_round_trip(self):
+        friends = [uuid.uuid4() for i in range(3)]
+        digest = FriendDigest.from_dict(json.loads(json.dumps(FriendDigest.build(friends, 0.01).as_dict())))
+        self.assertTrue(all(digest.might_contain(str(friend)) for friend in friends))
+        self.assertEqual(digest.version, FriendDigest.build(reversed(friends), 0.01).version)
+        self.assertNotEqual(digest.version, FriendDigest.build(friends[:2], 0.01).version)
+        empty = FriendDigest.build([], 0.01)
+        self.assertFalse(empty.might_contain(friends[0]))
+        with self.assertRaises(ValueError):
+            FriendDigest.from_dict(dict(empty.as_dict(), bits=8))
+
+class NodeClientTests(TestCase):
+
+    def setUp(self):
+        connections = self.connections = []
+        statuses = self.statuses = []
+        paths = self.paths = []
+        posted = self.posted = []
+        remote_friends = self.remote_friends = []
+        documents = self.documents = {}
+        path_statuses = self.path_statuses = {}
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                connections.append(self.client_address)
+                BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
+            def do_GET(self):
+                paths.append(self.path)
+                status = path_statuses.get(self.path) or (statuses.pop(0) if statuses else 200)
+                if status == 200 and self.headers.get('If-None-Match') == '"v1"':
+                    status = 304
+                body = documents.get(self.path, self.path + ' ' + self.headers.get('Authorization', '')) if status != 304 else ''
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('ETag', '"v1"')
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                paths.append(self.path)
+                query = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                posted.append(query)
+                body = json.dumps({'query': 'friends', 'author': query['author'],
+                    'authors': [friend for friend in query['authors'] if friend in remote_friends]})
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.node = mommy.make(Node, name='Test Node', url='http://127.0.0.1:%d/api' % self.server.server_port,
+            foreignNodeUser='user', foreignNodePass='pass')
+
+    def tearDown(self):
+        NodeClient.forget(self.node.pk)
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def test_url(self):
+        client = NodeClient(self.node)
+        self.assertEqual(client.url('posts'), self.node.url + '/posts')
+        self.assertEqual(client.url('/posts'), self.node.url + '/posts')
+        self.assertEqual(client.url('http://other/api/posts'), 'http://other/api/posts')
+
+    def test_connection_reused(self):
+        for i in range(3):
+            response = NodeClient(self.node).get('posts')
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.text.startswith('/api/posts Basic '))
+        self.assertEqual(len(self.connections), 1)
+
+    def test_retries_unavailable(self):
+        self.statuses.extend([503, 503])
+        self.assertEqual(NodeClient(self.node).get('posts').status_code, 200)
+        self.statuses.extend([503, 503, 503])
+        self.assertEqual(NodeClient(self.node).get('posts').status_code, 503)
+
+    def _cached_get(self, fresh, stale, max_bytes=1024):
+        with self.settings(NODE_RESPONSE_CACHE={'author': (fresh, stale, max_bytes)}):
+            return NodeClient(Node.objects.get(id=self.node.id)).get('author/1', cache='author')
+
+    @override_settings(NODE_REQUEST_RETRIES=0)
+    def test_response_cache(self):
+        response = self._cached_get(60, 60)
+        self.assertTrue(response.text.startswith('/api/author/1 Basic '))
+        self.assertEqual(len(self.paths), 1)
+        # Fresh, the node isn't asked
+        self.assertEqual(self._cached_get(60, 60).text, response.text)
+        self.assertEqual(len(self.paths), 1)
+        # Expired, revalidated with the ETag and the node answers 304
+        self.assertEqual(self._cached_get(0, 0).text, response.text)
+        self.assertEqual(len(self.paths), 2)
+        self.assertEqual(CachedResponse.objects.count(), 1)
+        # The node is down, the old response is better than nothing
+        self.statuses.append(500)
+        response = self._cached_get(0, 0)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.paths), 3)
+
+    def test_response_cache_max_bytes(self):
+        self.documents['/api/author/1'] = body = 'x' * 200000
+        # Too large to keep, but the caller still gets all of it
+        self.assertEqual(self._cached_get(60, 60, max_bytes=1000).text, body)
+        self.assertFalse(CachedResponse.objects.exists())
+        self.assertEqual(self._cached_get(60, 60, max_bytes=1000).content, body)
+        self.assertEqual(len(self.paths), 2)
+        self.assertEqual(len(self.connections), 1)
+
+    def test_response_cache_stale_while_revalidate(self):
+        self._cached_get(60, 60)
+        # Stale: answered from the cache right away, refreshed in the background
+        self.assertTrue(self._cached_get(0, 60).text.startswith('/api/author/1'))
+        for i in range(50):
+            if len(self.paths) == 2:
+                break
+            time.sleep(0.05)
+        self.assertEqual(len(self.paths), 2)
+
+    @override_settings(NODE_REQUEST_RETRIES=0, NODE_FAILURE_THRESHOLD=2)
+    def test_circuit_breaker(self):
+        NodeClient.forget(self.node.pk)
+        self.assertEqual(NodeClient(self.node).get('posts').status_code, 200)
+        node = Node.objects.get(id=self.node.id)
+        self.assertIsNotNone(node.latency_ms)
+        self.assertIsNotNone(node.last_success_on)
+
+        self.statuses.extend([500, 500])
+        NodeClient(node).get('posts')
+        self.assertTrue(Node.objects.get(id=node.id).is_available())
+        NodeClient(node).get('posts')
+        self.assertEqual(Node.objects.get(id=node.id).consecutive_failures, 2)
+        self.assertFalse(Node.objects.get(id=node.id).is_available())
+
+        # Not called while open, from this instance or a fresh one
+        calls = len(self.paths)
+        with self.assertRaises(NodeUnavailable):
+            NodeClient(node).get('posts')
+        with self.assertRaises(NodeUnavailable):
+            NodeClient(Node.objects.get(id=node.id)).get('posts')
+        self.assertEqual(len(self.paths), calls)
+
+        # After the cool-down a single request gets through
+        Node.objects.filter(id=node.id).update(circuit_open_until=timezone.now())
+        probe, other = NodeClient(Node.objects.get(id=node.id)), NodeClient(Node.objects.get(id=node.id))
+        self.assertTrue(probe._may_send())
+        with self.assertRaises(NodeUnavailable):
+            other.get('posts')
+        self.assertEqual(len(self.paths), calls)
+
+        # A failed probe opens it for another cool-down
+        Node.objects.filter(id=node.id).update(circuit_open_until=timezone.now())
+        self.statuses.append(500)
+        self.assertEqual(NodeClient(Node.objects.get(id=node.id)).get('posts').status_code, 500)
+        self.assertFalse(Node.objects.get(id=node.id).is_available())
+
+        # A successful one closes it again, also for the clients that loaded the node before that
+        Node.objects.filter(id=node.id).update(circuit_open_until=timezone.now())
+        other = NodeClient(Node.objects.get(id=node.id))
+        self.assertEqual(NodeClient(Node.objects.get(id=node.id)).get('posts').status_code, 200)
+        node = Node.objects.get(id=node.id)
+        self.assertTrue(node.is_available())
+        self.assertEqual(node.consecutive_failures, 0)
+        self.assertEqual(other.get('posts').status_code, 200)
+
+    def test_is_foaf_remote_cached(self):
+        viewer = mommy.make(Author)
+        friend = mommy.make(Author)
+        remote = mommy.make(ForeignAuthor, node=self.node)
+        # No friends, nothing to ask
+        self.assertFalse(is_FOAF_remote(viewer, remote))
+        self.assertEqual(self.posted, [])
+
+        viewer.friends.add(friend)
+        self.remote_friends.append(str(friend.uuid))
+        self.assertTrue(is_FOAF_remote(viewer, remote))
+        self.assertEqual(self.paths, ['/api/friends/' + str(remote.id) + '/'])
+        self.assertEqual(self.posted, [{'query': 'friends', 'author': str(remote.id), 'authors': [str(friend.uuid)]}])
+        # Remembered
+        self.assertTrue(is_FOAF_remote(viewer, remote))
+        self.assertEqual(len(self.posted), 1)
+
+        # The viewer's friends changed
+        viewer.friends.remove(friend)
+        viewer.friends.add(friend)
+        self.assertTrue(is_FOAF_remote(viewer, remote))
+        self.assertEqual(len(self.posted), 2)
+
+        # The remote author's friends changed on this node
+        del self.remote_friends[:]
+        other = mommy.make(Author)
+        other.foreign_friends.add(remote)
+        self.assertFalse(is_FOAF_remote(viewer, remote))
+        self.assertFalse(is_FOAF_remote(viewer, remote))
+        self.assertEqual(len(self.posted), 3)
+
+        # Cleared on this node
+        self.remote_friends.append(str(friend.uuid))
+        other.foreign_friends.clear()
+        self.assertTrue(is_FOAF_remote(viewer, remote))
+        self.assertEqual(len(self.posted), 4)
+
+        # An answer asked for before the friends changed isn't cached under the new versions
+        answer, versions = FOAFCache.get(viewer.uuid, remote.id)
+        FOAFCache.invalidate([viewer.uuid])
+        FOAFCache.set(viewer.uuid, remote.id, False, versions)
+        self.assertIsNone(FOAFCache.get(viewer.uuid, remote.id)[0])
+
+    def test_iter_node_posts_pages(self):
+        page_2 = self.node.url + '/posts?page=2'
+        self.documents['/api/posts'] = json.dumps({'next': page_2, 'posts': [{'id': '1'}, {'id': '2'}]})
+        self.documents['/api/posts?page=2'] = json.dumps({'posts': [{'id': '3'}], 'next': None})
+        self.assertEqual([post['id'] for post in iter_node_posts(self.node)], ['1', '2', '3'])
+        self.assertEqual(self.paths, ['/api/posts', '/api/posts?page=2'])
+        # Stops once it has enough, without asking for the next page
+        self.assertEqual([post['id'] for post in iter_node_posts(self.node, max_posts=2)], ['1', '2'])
+        self.assertEqual(len(self.paths), 3)
+        # The connections went back to the pool
+        self.assertEqual(len(self.connections), 1)
+
+    @override_settings(NODE_FEED_MAX_BYTES=5000, NODE_RESPONSE_CACHE={'author_posts': (60, 60, 1000)})
+    def test_iter_node_posts_cached_too_large(self):
+        self.documents['/api/author/1/posts'] = json.dumps({'posts': [{'id': str(i)} for i in range(20000)]})
+        with self.assertRaises(FeedError):
+            list(iter_node_posts(self.node, 'author/1/posts', cache='author_posts'))
+        self.assertFalse(CachedResponse.objects.exists())
+
+    def test_iter_node_posts_stays_on_node(self):
+        self.documents['/api/posts'] = json.dumps({'next': 'http://localhost:%d/api/posts?page=2' % self.server.server_port,
+            'posts': [{'id': '1'}]})
+        self.assertEqual([post['id'] for post in iter_node_posts(self.node)], ['1'])
+        self.assertEqual(self.paths, ['/api/posts'])
+        # Relative links are on the node
+        self.documents['/api/posts'] = json.dumps({'next': 'posts?page=2', 'posts': [{'id': '1'}]})
+        self.documents['/api/posts?page=2'] = json.dumps({'posts': [{'id': '2'}]})
+        self.assertEqual([post['id'] for post in iter_node_posts(self.node)], ['1', '2'])
+
+    def _post_json(self, post_id):
+        return {'id': post_id, 'title': 'A remote post', 'content': 'remote', 'contentType': 'text/plain',
+            'visibility': 'PUBLIC', 'published': '2016-11-20T10:00:00Z',
+            'author': {'id': 'a1b2', 'host': self.node.url, 'displayName': 'Joe', 'url': self.node.url + '/author/a1b2'}}
+
+    def test_sync_unlists_missing_posts(self):
+        store_posts(self.node, [self._post_json(post_id) for post_id in ('1', '2', '3')], listed=True)
+        store_posts(self.node, [self._post_json('4')], listed=False)
+        # 3 was deleted or isn't public anymore, but the list didn't come through completely
+        self.documents['/api/posts'] = json.dumps({'posts': [self._post_json('1')],
+            'next': 'http://localhost:%d/api/posts?page=2' % self.server.server_port})
+        sync_node_posts(self.node)
+        self.assertEqual(set(ForeignPost.objects.filter(listed=True).values_list('post_id', flat=True)), set(['1', '2', '3']))
+
+        self.documents['/api/posts'] = json.dumps({'posts': [self._post_json('1')], 'next': 'posts?page=2'})
+        self.documents['/api/posts?page=2'] = json.dumps({'posts': [self._post_json('2')], 'next': None})
+        sync_node_posts(self.node)
+        self.assertEqual(set(ForeignPost.objects.filter(listed=True).values_list('post_id', flat=True)), set(['1', '2']))
+        # Still there for links to it
+        self.assertEqual(ForeignPost.objects.count(), 4)
+
+    def test_reconcile_skips_unusable_answer(self):
+        author = mommy.make(Author)
+        gone = mommy.make(ForeignAuthor, node=self.node)
+        friends = [mommy.make(ForeignAuthor, node=self.node) for i in range(2)]
+        author.foreign_friends.add(gone, *friends)
+        self.path_statuses['/api/friends/%s/%s' % (author.uuid, gone.id)] = 404
+        for friend in friends:
+            self.documents['/api/friends/%s/%s' % (author.uuid, friend.id)] = json.dumps({'friends': True})
+        pairs = [(author, gone)] + [(author, friend) for friend in friends]
+        # The pair the node can't answer for waits for the next interval, the others still get checked
+        self.assertEqual(reconcile_node_friendships(pairs), 3)
+        self.assertEqual(len(self.paths), 3)
+        self.assertEqual(ForeignFriendCheck.objects.filter(author=author).count(), 3)
+        self.assertEqual(set(author.foreign_friends.all()), set([gone] + friends))
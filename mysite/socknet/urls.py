@@ -9,6 +9,8 @@ from socknet.views import api_views, admin_views, author_views, post_views
 
 urlpatterns = [
     # API: Friends
+    url(r'^api/friends/check/$', api_views.FriendshipsQuery.as_view(), name="api_friendships_query"),
+    url(r'^api/friends/(?P<authorid>[0-9A-Fa-f-]+)/digest/$', api_views.FriendsDigestQuery.as_view(), name="api_friends_digest"),
     url(r'^api/friends/(?P<authorid1>[0-9A-Fa-f-]+)/(?P<authorid2>[0-9A-Fa-f-]+)/', api_views.IsFriendQuery.as_view(), name="api_is_friend_query"),
     url(r'^api/friends/(?P<authorid>[0-9A-Fa-f-]+)/$', api_views.FriendsQuery.as_view(), name="api_friend_query"),
     url(r'^api/friendrequest/', api_views.FriendRequest.as_view(), name="api_friend_request"),
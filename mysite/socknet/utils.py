@@ -1,39 +1,80 @@
 from django.utils import html
 from django.http import HttpResponse
+from django.core.cache import cache
+from django.conf import settings
 import CommonMark
 import HTMLParser
 import requests
 import json
+import re
+import time
 import uuid
+import multiprocessing
+from itertools import chain
+from multiprocessing.pool import ThreadPool
+from django.db import connections
+from socknet.node_client import NodeClient
 
 class HTMLsafe():
     """ Makes text html safe and can apply markdown """
+    # Bump when get_converted_content's output changes, so stored html gets rendered again.
+    RENDERER_VERSION = 1
+
+    # An opening or closing <code> tag, spaces anywhere in the tag are ignored.
+    # The text can also start with the tag without the '<'.
+    _CODE_TAG = re.compile(r'< *(/)? *c *o *d *e *>')
+    _CODE_TAG_AT_START = re.compile(r' *(/)? *c *o *d *e *>')
+    # The entities HTMLParser.unescape decodes.
+    _ENTITY = re.compile(r"&(#?[xX]?(?:[0-9a-fA-F]+|\w{1,8}));")
+    _parser = HTMLParser.HTMLParser()
+
+    @staticmethod
+    def _unescape(text):
+        """ Same as HTMLParser.unescape, but each distinct entity is only decoded once. """
+        if '&' not in text:
+            return text
+        # Every odd part is the name of an entity.
+        parts = HTMLsafe._ENTITY.split(text)
+        decoded = {}
+        for i in range(1, len(parts), 2):
+            name = parts[i]
+            if name not in decoded:
+                decoded[name] = HTMLsafe._parser.unescape('&' + name + ';')
+            parts[i] = decoded[name]
+        return ''.join(parts)
+
     @staticmethod
     def _unescape_markdown(text):
         """ Removes HTML escape characters from given text for <code> tags
         in markdown to work properly: any contents within the <code></code> tags
         gets decoded. Then returns the result.
 
+        Walks the code tags in one pass and decodes each run of text that is
+        inside <code> at once, text outside of code is copied as is.
+        The text from a tag up to the next '<' counts as part of that tag's run.
         """
-        tmp = text
-        # Anything within <code></code> will be decoded.
-        parser = HTMLParser.HTMLParser()
-        # Split by the commonmark generated tags (they're not user generated).
-        tmp = tmp.split('<')
-        starts = 0
-        ends = 0
-        code_tag_contents = []
-        for each in tmp:
-            if each.replace(' ','').startswith('code>'):
-                starts += 1
-            if each.replace(' ','').startswith('/code>'):
-                ends += 1
-            # if currently within a <code> tag, decode html escape chars.
-            if starts > ends:
-                code_tag_contents.append(parser.unescape(each))
+        result = []
+        depth = 0 # opened minus closed code tags
+        run_start = 0
+        tags = HTMLsafe._CODE_TAG.finditer(text)
+        first_tag = HTMLsafe._CODE_TAG_AT_START.match(text)
+        if first_tag:
+            tags = chain([first_tag], tags)
+        for tag in tags:
+            run = text[run_start:tag.start()]
+            if depth > 0:
+                run = HTMLsafe._unescape(run)
+            result.append(run)
+            if tag.group(1):
+                depth -= 1
             else:
-                code_tag_contents.append(each)
-        return '<'.join(code_tag_contents)
+                depth += 1
+            run_start = tag.start()
+        run = text[run_start:]
+        if depth > 0:
+            run = HTMLsafe._unescape(run)
+        result.append(run)
+        return ''.join(result)
 
     @staticmethod
     def get_converted_content(markdown, text):
@@ -57,6 +98,103 @@ class HTMLsafe():
             url = url + "/"
         return url
 
+def _get_cache_versions(version_key, ids, timeout):
+    """ Returns the current cache version of each id, starting a new one for those that have none. """
+    version_keys = dict((version_key(item_id), item_id) for item_id in ids)
+    found = cache.get_many(version_keys.keys())
+    versions = {}
+    new_versions = {}
+    for key, item_id in version_keys.items():
+        if key in found:
+            versions[item_id] = found[key]
+        else:
+            versions[item_id] = new_versions[key] = uuid.uuid4().hex
+    if new_versions:
+        cache.set_many(new_versions, timeout)
+    return versions
+
+class PostCache():
+    """
+    Caches the serialized api document of each local post per host, since posts
+    change a lot less often than other nodes poll for them.
+    Every post has a version key that is part of its document keys, invalidating a
+    post drops the version so all of its documents (for every host) become unreachable.
+    """
+    @staticmethod
+    def _version_key(post_id):
+        return "post_version:" + str(post_id)
+
+    @staticmethod
+    def _document_key(post_id, version, host):
+        return "post_json:" + str(post_id) + ":" + version + ":" + host
+
+    @staticmethod
+    def _get_versions(post_ids):
+        return _get_cache_versions(PostCache._version_key, post_ids, settings.POST_CACHE_TIMEOUT)
+
+    @staticmethod
+    def get_many(post_ids, host):
+        """
+        Returns a dict of post id to cached document for the posts that are cached, and the
+        versions it looked them up under. Pass those to set_many, so a document built from
+        data read before an invalidation isn't cached under the version that replaced it.
+        """
+        versions = PostCache._get_versions(post_ids)
+        document_keys = dict((PostCache._document_key(post_id, versions[post_id], host), post_id) for post_id in post_ids)
+        found = cache.get_many(document_keys.keys())
+        return dict((document_keys[key], document) for key, document in found.items()), versions
+
+    @staticmethod
+    def set_many(documents, host, versions):
+        """ Caches a dict of post id to serialized document under the versions get_many returned. """
+        cache.set_many(dict((PostCache._document_key(post_id, versions[post_id], host), document)
+            for post_id, document in documents.items()), settings.POST_CACHE_TIMEOUT)
+
+    @staticmethod
+    def invalidate(post_id):
+        cache.delete(PostCache._version_key(post_id))
+
+    @staticmethod
+    def invalidate_many(post_ids):
+        cache.delete_many([PostCache._version_key(post_id) for post_id in post_ids])
+
+class FOAFCache():
+    """
+    Remembers whether a local author is a friend of a friend of a remote author, so
+    viewing a popular remote profile doesn't ask their node every time.
+    Like PostCache, every author (local uuid or foreign id) has a version key that is part
+    of the answer keys, so invalidating either side of a pair drops the answer.
+    """
+    @staticmethod
+    def _version_key(author_id):
+        return "friends_version:" + str(author_id)
+
+    @staticmethod
+    def _answer_key(viewer_id, remote_id, versions):
+        return "foaf:" + str(viewer_id) + ":" + versions[viewer_id] + ":" + str(remote_id) + ":" + versions[remote_id]
+
+    @staticmethod
+    def _get_versions(author_ids):
+        return _get_cache_versions(FOAFCache._version_key, author_ids, settings.FOAF_CACHE_TIMEOUT)
+
+    @staticmethod
+    def get(viewer_id, remote_id):
+        """
+        Returns the cached answer, or None if there isn't one, and the versions it was looked up
+        under. Pass those to set, so an answer asked for before either side's friends changed
+        isn't cached under the new versions.
+        """
+        versions = FOAFCache._get_versions([viewer_id, remote_id])
+        return cache.get(FOAFCache._answer_key(viewer_id, remote_id, versions)), versions
+
+    @staticmethod
+    def set(viewer_id, remote_id, is_foaf, versions):
+        cache.set(FOAFCache._answer_key(viewer_id, remote_id, versions), is_foaf, settings.FOAF_CACHE_TIMEOUT)
+
+    @staticmethod
+    def invalidate(author_ids):
+        cache.delete_many([FOAFCache._version_key(author_id) for author_id in author_ids])
+
 class ForbiddenContent403():
     @staticmethod
     def denied():
@@ -165,7 +303,7 @@ class PostDetails():
         self.is_local = True
         self.title = local_post.title
         self.description = local_post.description
-        self.content = local_post.content
+        self.content = local_post.view_content()
         self.visibility = local_post.visibility
         self.published = local_post.created_on
         self.author_display_name = local_post.author.displayName
@@ -203,71 +341,99 @@ class PostDetails():
         else:
             self.content = HTMLsafe.get_converted_content(False, content)
 
+def _call_in_thread(func, item):
+    try:
+        return func(item)
+    finally:
+        # Django opens a database connection per thread, don't leave it behind.
+        connections.close_all()
+
+def call_concurrently(func, items, deadline):
+    """
+    Calls func(item) for every item on a pool of at most NODE_FETCH_WORKERS threads
+    and waits at most deadline seconds for all of them.
+    Returns (results, failures): (item, return value) for the calls that finished in time,
+    and (item, reason) for the ones that raised or were still running at the deadline.
+    Calls still running carry on in the background and their results are dropped.
+    """
+    if not items:
+        return [], []
+    pool = ThreadPool(min(settings.NODE_FETCH_WORKERS, len(items)))
+    pending = [(item, pool.apply_async(_call_in_thread, (func, item))) for item in items]
+    pool.close()
+    end = time.time() + deadline
+    results = []
+    failures = []
+    for item, async_result in pending:
+        try:
+            results.append((item, async_result.get(max(end - time.time(), 0))))
+        except multiprocessing.TimeoutError:
+            failures.append((item, "No response within " + str(deadline) + " seconds"))
+        except Exception as e:
+            failures.append((item, str(e) or e.__class__.__name__))
+    return results, failures
+
 def is_FOAF_local(viewing_author, profile_author):
     """
     When a local author views another local author's profile and we want
     to check if the viewing author is a FOAF.
 
     How this algorithm works:
-        - Check if any of the viewers friends are the profile author's friends
+        - Check if any of the viewers friends are the profile author's friends,
+          in the database with one EXISTS query (see AuthorQuerySet.FOAF_of)
     """
-    viewers_friends = viewing_author.get_all_friend_uuids()
-    print(viewers_friends)
-    profile_friends = profile_author.get_all_friend_uuids()
-    print(profile_friends)
-    intersect = list(set(viewers_friends) & set(profile_friends))
-    if len(intersect):
-        return True
-    return False
+    return profile_author.__class__.objects.filter(pk=profile_author.pk).FOAF_of(viewing_author).exists()
 
 def is_FOAF_remote(viewing_author, remote_author):
     """
     When a local author views a remote author's profile and we want to check if
     the viewing author is a FOAF.
+
+    How this algorithm works:
+        - Send the viewer's friends to the remote node with POST friends/<id>,
+          it answers with the ones that are also the remote author's friends
+        - Remember the answer in FOAFCache until either side's friends change
     """
-    viewers_friends = viewing_author.get_all_friend_uuids()
-    print("\nViewers Friends")
-    print(viewers_friends)
+    is_foaf, versions = FOAFCache.get(viewing_author.uuid, remote_author.id)
+    if is_foaf is not None:
+        return is_foaf
+
+    viewers_friends = [str(friend_uuid) for friend_uuid in viewing_author.get_all_friend_uuids()]
+    if not viewers_friends:
+        return False
+
+    query = {
+        "query": "friends",
+        "author": str(remote_author.id),
+        "authors": viewers_friends,
+    }
     # Send a request to remote node
-    url = remote_author.node.url
-    if url[-1] is not "/":
-        url = url + "/"
-    response = None
     try:
-        response = requests.get(url=url + 'friends/' + str(remote_author.id), auth=requests.auth.HTTPBasicAuth(remote_author.node.foreignNodeUser, remote_author.node.foreignNodePass), timeout=5)
-    except requests.exceptions.Timeout as error:
+        response = NodeClient(remote_author.node).post('friends/' + str(remote_author.id) + '/',
+            data=json.dumps(query), headers={'content-type': 'application/json'})
+    except requests.exceptions.RequestException as error:
         # if we timeout, assume not FOAF
-        print("The request timed out for FOAF call" + remote_author.display_name + " from " + remote_author.node.name)
+        print("The request failed for FOAF call" + remote_author.display_name + " from " + remote_author.node.name)
         return False
 
-    if response.status_code is not 200:
+    if response.status_code != 200:
         # Assume not FOAF
         print "Error making remote FOAF call, response code was " + str(response.status_code) + " from " + remote_author.node.name
         return False
 
-    # Ensure we got data back
-    if (len(response.text) < 1):
-        print "Error making remote FOAF call, response text was empty from " + remote_author.node.name
-        return False
-
     try:
         data = json.loads(response.text)
-        remote_friends = []
-        for friend_uuid in data['authors']:
-            remote_friends.append(uuid.UUID(friend_uuid))
-        print("\n Returned Friends")
-        print(remote_friends)
-
-        intersect = list(set(viewers_friends) & set(remote_friends))
-        if len(intersect):
-            return True
-        return False
-
+        # Only count uuids we actually asked about
+        matching = set(str(uuid.UUID(friend_uuid)) for friend_uuid in data['authors']) & set(viewers_friends)
     except Exception as error:
         # If we could not parse the response, then assume not FOAF
         print "Error making remote FOAF call, could not parse reponse " + str(error) + " from " + remote_author.node.name
         return False
 
+    is_foaf = len(matching) > 0
+    FOAFCache.set(viewing_author.uuid, remote_author.id, is_foaf, versions)
+    return is_foaf
+
 def is_FOAF_str_remote(local_author, remote_author_uuid, remote_node):
     """
     When a local author views a remote author's profile and we want to check if
@@ -277,13 +443,10 @@ def is_FOAF_str_remote(local_author, remote_author_uuid, remote_node):
     print("\nViewers Friends")
     print(viewers_friends)
     # Send a request to remote node
-    url = remote_author.node.url
-    if url[-1] is not "/":
-        url = url + "/"
     response = None
     try:
-        response = requests.get(url=url + 'friends/' + str(remote_author_uuid), auth=requests.auth.HTTPBasicAuth(remote_author.node.foreignNodeUser, remote_author.node.foreignNodePass), timeout=5)
-    except requests.exceptions.Timeout as error:
+        response = NodeClient(remote_node).get('friends/' + str(remote_author_uuid))
+    except requests.exceptions.RequestException as error:
         # if we timeout, assume not FOAF
         print("The request timed out for FOAF call" + remote_author_uuid + " from " + remote_node)
         return False
@@ -323,16 +486,18 @@ def update_friend_status(local_author, foreign_author):
     There are 2 states we need to consider:
       - We are friends with them locally and they may have deleted it
       - We have sent them a friend request and we need to check if they accepted it
+    Returns True if the other server answered, the friend data is up to date then, and None if its
+    answer couldn't be used. Raises RequestException when the node can't be reached or answers
+    with a server error, asking it about other pairs won't go any better then.
     """
-    url = foreign_author.node.url
-    if url[-1] is not "/":
-        url = url + "/"
     try:
-        response = requests.get(url + 'friends/' + str(local_author.uuid) + "/" + str(foreign_author.id) , auth=requests.auth.HTTPBasicAuth(foreign_author.node.foreignNodeUser, foreign_author.node.foreignNodePass), timeout=5)
-    except requests.exceptions.Timeout as error:
-        print("The request timed out for is friends call" + foreign_author.display_name + " from " + foreign_author.node.name)
-        # If we could not get a reponse, then don't change data state and assume it is correct.
-        return
+        response = NodeClient(foreign_author.node).get('friends/' + str(local_author.uuid) + "/" + str(foreign_author.id))
+    except requests.exceptions.RequestException as error:
+        print("The request failed for is friends call" + foreign_author.display_name + " from " + foreign_author.node.name)
+        raise
+
+    if response.status_code >= 500:
+        raise requests.exceptions.HTTPError("Check is friends Error: Response code was " + str(response.status_code) + " from " + foreign_author.node.name, response=response)
 
     # Ensure we got a 200
     if response.status_code is not 200:
@@ -356,7 +521,7 @@ def update_friend_status(local_author, foreign_author):
             if not status:
                 print "Remote author is not friends. Remove locally."
                 local_author.foreign_friends.remove(foreign_author)
-                return
+                return True
             print "Remote author is friends. Do nothing."
         elif foreign_author in local_author.foreign_friends_im_following.all():
             # We are here because we are checking if the remote author accepted our friend request
@@ -364,8 +529,9 @@ def update_friend_status(local_author, foreign_author):
                 print "Remote author accepted our friend request! Update it."
                 local_author.foreign_friends_im_following.remove(foreign_author)
                 local_author.foreign_friends.add(foreign_author)
-                return
+                return True
             print "Remote author has not accepted our friend request yet."
+        return True
 
     except Exception as error:
         # If we could not parse the response, then don't change data state
@@ -1,15 +1,24 @@
 import base64
+import hashlib
 from itertools import chain
+from django.conf import settings
 from rest_framework import viewsets, status
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework.authentication import BasicAuthentication
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.exceptions import NotFound
+from rest_framework.utils.urls import replace_query_param
+from django.utils.dateparse import parse_datetime
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
 from rest_framework.permissions import IsAuthenticated
+from django.db.models import Count, Max, Prefetch, Q, prefetch_related_objects
 
+from socknet.authentication import NodeBasicAuthentication
 from socknet.serializers import *
 from socknet.models import Author, Post, ImageServ, Comment
 from socknet.utils import *
+from socknet.friend_digest import FriendDigest
 
 ### HELPER FUNCTIONS ###
 
@@ -19,6 +28,108 @@ def get_page_size(request, paginator):
     else:
         return paginator.page_size
 
+def get_posts_paginator(request):
+    """
+    Nodes opt in to keyset pagination by sending a cursor parameter
+    (empty for the first page), everyone else gets page numbers.
+    """
+    if PostsCursorPagination.cursor_query_param in request.GET:
+        return PostsCursorPagination()
+    return PostsPagination()
+
+def prefetch_comments(posts):
+    """
+    Loads the local and foreign comments (with their authors and nodes) for a page
+    of posts in a fixed number of queries, newest first.
+    PostsSerializer reads the comments from this cache instead of querying per post.
+    """
+    prefetch_related_objects(posts,
+        Prefetch('comment_parent_post',
+            queryset=Comment.objects.select_related('author').order_by('-created_on')),
+        Prefetch('foreign_comment_parent_post',
+            queryset=ForeignComment.objects.select_related('foreign_author__node').order_by('-created_on')))
+    return posts
+
+def prepare_post(request, post):
+    """
+    Sets the extra attributes PostsSerializer expects on a local post.
+    """
+    # TODO: Difference in source vs origin?
+    post.source = request.scheme + "://" + str(request.META["HTTP_HOST"]) + "/posts/" + str(post.id)
+    post.origin = request.scheme + "://" + str(request.META["HTTP_HOST"]) + "/posts/" + str(post.id)
+    post.published = post.created_on
+    if (post.markdown == False):
+        post.contentType = "text/plain"
+    else:
+        post.contentType = "text/x-markdown"
+    post.author.id = post.author.uuid
+    post.author.host = "http://" + request.get_host() + "/api"
+    if len(post.author.github_url) > 0:
+        post.author.github = "http://" + post.author.github_url
+    else:
+        post.author.github = post.author.github_url
+    return post
+
+def serialize_posts(request, posts):
+    """
+    Returns the serialized posts in order.
+    Posts already in the PostCache are reused, only the misses are prefetched,
+    serialized and cached.
+    """
+    host = request.scheme + "://" + request.get_host()
+    serialized, versions = PostCache.get_many([post.id for post in posts], host)
+    missing = [post for post in posts if post.id not in serialized]
+    if missing:
+        prefetch_comments(missing)
+        for post in missing:
+            prepare_post(request, post)
+        posts_serializer = PostsSerializer(missing, many=True)
+        fresh = dict(zip([post.id for post in missing], posts_serializer.data))
+        PostCache.set_many(fresh, host, versions)
+        serialized.update(fresh)
+    return [serialized[post.id] for post in posts]
+
+def get_posts_validators(request, posts, *extra):
+    """
+    Returns the (etag, last_modified) validators of a response built from the posts,
+    their comments and the authors of both, without serializing anything.
+    Editing a post or comment updates its created_on, adding or deleting changes
+    the ids and counts, and extra is for anything else the response depends on.
+    There is no Last-Modified: deleting the newest post or comment would move it back,
+    and a node asking If-Modified-Since would keep its stale copy.
+    """
+    post_ids = [post.id for post in posts]
+    local_comments = Comment.objects.filter(parent_post_id__in=post_ids)
+    remote_comments = ForeignComment.objects.filter(parent_post_id__in=post_ids)
+    local = local_comments.aggregate(newest=Max('created_on'), count=Count('id'))
+    foreign = remote_comments.aggregate(newest=Max('created_on'), count=Count('guid'))
+    state = [request.get_host(), request.get_full_path()]
+    state += [(str(post.id), post.created_on.isoformat(), str(post.author.uuid), post.author.displayName,
+        post.author.url, post.author.github_url) for post in posts]
+    state += [(str(comments['newest']), comments['count']) for comments in (local, foreign)]
+    # The comment authors are embedded too
+    state += list(local_comments.order_by('author_id').distinct()
+        .values_list('author__uuid', 'author__displayName', 'author__url', 'author__github_url'))
+    state += list(remote_comments.order_by('foreign_author_id').distinct()
+        .values_list('foreign_author_id', 'foreign_author__display_name', 'foreign_author__url', 'foreign_author__node__url'))
+    state += list(extra)
+    etag = hashlib.md5(repr(state)).hexdigest()
+    return etag, None
+
+def get_not_modified(request, validators):
+    """
+    Returns a 304 response if the node already has this version (If-None-Match / If-Modified-Since), otherwise None.
+    """
+    etag, last_modified = validators
+    return get_conditional_response(request, etag=etag, last_modified=last_modified)
+
+def set_validators(response, validators):
+    etag, last_modified = validators
+    response['ETag'] = quote_etag(etag)
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    return response
+
 ### PAGINATION ###
 class PostsPagination(PageNumberPagination):
     page_size = 50
@@ -26,6 +137,75 @@ class PostsPagination(PageNumberPagination):
     page_size_query_param = 'size'
     # max_page_size = 10
 
+    def get_count(self):
+        # The paginator already counted the queryset, don't load it again.
+        return self.page.paginator.count
+
+class PostsCursorPagination(BasePagination):
+    """
+    Keyset pagination on (created_on, id), newest first.
+    Each page is a range scan on the post index starting after the last post
+    of the previous page, so deep pages cost the same as the first one.
+    There is no total count and no previous link, just follow "next".
+    GET /api/posts?cursor=
+    """
+    page_size = 50
+    page_size_query_param = 'size'
+    cursor_query_param = 'cursor'
+
+    def encode_cursor(self, post):
+        position = post.created_on.isoformat() + "|" + str(post.id)
+        return base64.urlsafe_b64encode(position)
+
+    def decode_cursor(self, cursor):
+        """
+        Returns the (created_on, id) position of the cursor, or None for the first page.
+        """
+        if not cursor:
+            return None
+        try:
+            created_on, post_id = base64.urlsafe_b64decode(str(cursor)).split("|")
+            created_on = parse_datetime(created_on)
+            post_id = uuid.UUID(post_id)
+        except (TypeError, ValueError):
+            raise NotFound("Invalid cursor.")
+        if created_on is None:
+            raise NotFound("Invalid cursor.")
+        return created_on, post_id
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = get_page_size(request, self)
+        if self.page_size < 1:
+            raise NotFound("Invalid page size.")
+        queryset = queryset.order_by('-created_on', '-id')
+        position = self.decode_cursor(request.GET.get(self.cursor_query_param))
+        if position is not None:
+            created_on, post_id = position
+            # The created_on__lte bound lets the database seek straight to the position in the index.
+            queryset = queryset.filter(created_on__lte=created_on).filter(
+                Q(created_on__lt=created_on) | Q(created_on=created_on, id__lt=post_id))
+        # Fetch one extra post to know if there is a next page.
+        posts = list(queryset[:self.page_size + 1])
+        self.next_post = None
+        if len(posts) > self.page_size:
+            posts = posts[:self.page_size]
+            self.next_post = posts[-1]
+        return posts
+
+    def get_count(self):
+        # Counting would scan the whole table, which is what we are avoiding.
+        return None
+
+    def get_next_link(self):
+        if self.next_post is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.next_post))
+
+    def get_previous_link(self):
+        return None
+
 class AuthorPostsPagination(PageNumberPagination):
     page_size = 50
 
@@ -35,7 +215,7 @@ class AuthorPostsViewSet(APIView):
     API endpoint that allows an authenticated user to see all posts they are allowed to see
     GET /api/author/posts
     """
-    authentication_classes = (BasicAuthentication,)
+    authentication_classes = (NodeBasicAuthentication,)
     permission_classes = (IsAuthenticated,)
     pagination_class = AuthorPostsPagination
 
@@ -47,32 +227,21 @@ class AuthorPostsViewSet(APIView):
             SEND EVERYTHING BUT SERVERONLY BECAUSE HINDLE SAID ITS THE CLIENTS
             RESPONSIBILITY TO FILTER SHIT
             """
-            final_queryset = Post.objects.exclude(visibility="SERVERONLY").order_by('-created_on')
+            final_queryset = Post.objects.exclude(visibility="SERVERONLY").select_related('author').order_by('-created_on')
 
-            paginator = PostsPagination()
+            paginator = get_posts_paginator(request)
             posts = paginator.paginate_queryset(final_queryset, request)
-            for post in posts:
-                # TODO: Difference in source vs origin?
-                post.source = request.scheme + "://" + str(request.META["HTTP_HOST"]) + "/posts/" + str(post.id)
-                post.origin = request.scheme + "://" + str(request.META["HTTP_HOST"]) + "/posts/" + str(post.id)
-                post.published = post.created_on
-                if (post.markdown == False):
-                    post.contentType = "text/plain"
-                else:
-                    post.contentType = "text/x-markdown"
-                post.author.id = post.author.uuid
-                post.author.host = "http://" + request.get_host() + "/api"
-                if len(post.author.github_url) > 0:
-                    post.author.github = "http://" + post.author.github_url
-                else:
-                    post.author.github = post.author.github_url
-
-            posts_serializer = PostsSerializer(posts, many=True)
+            validators = get_posts_validators(request, posts, paginator.get_count())
+            not_modified = get_not_modified(request, validators)
+            if not_modified is not None:
+                return not_modified
             response = {
                 "query" : "posts",
-                "count" : len(final_queryset),
                 "size": get_page_size(request, paginator),
-                "posts" : posts_serializer.data}
+                "posts" : serialize_posts(request, posts)}
+            # Cursor pages don't have a count.
+            if (paginator.get_count() is not None):
+                response['count'] = paginator.get_count()
            # Do not return previous if page is 0.
             if (paginator.get_previous_link() is not None):
                response['previous'] = paginator.get_previous_link()
@@ -81,7 +250,7 @@ class AuthorPostsViewSet(APIView):
             if (paginator.get_next_link() is not None):
                 response['next'] = paginator.get_next_link()
 
-            return Response(response)
+            return set_validators(Response(response), validators)
         except Author.DoesNotExist:
             return Response({'Error': 'The author does not exist.'}, status=status.HTTP_404_NOT_FOUND)
 
@@ -90,7 +259,7 @@ class AuthorViewAllTheirPosts(APIView):
     API endpoint that allows an authenticated user to see all posts from a specific author
     GET /api/author/{author}/posts
     """
-    authentication_classes = (BasicAuthentication,)
+    authentication_classes = (NodeBasicAuthentication,)
     permission_classes = (IsAuthenticated,)
     pagination_class = AuthorPostsPagination
 
@@ -99,39 +268,28 @@ class AuthorViewAllTheirPosts(APIView):
         try:
             auth_obj = Author.objects.get(uuid=auth_id)
             # all posts except server only posts
-            final_queryset = Post.objects.filter(author=auth_obj).exclude(visibility="SERVERONLY").order_by('-created_on')
+            final_queryset = Post.objects.filter(author=auth_obj).exclude(visibility="SERVERONLY").select_related('author').order_by('-created_on')
 
-            paginator = PostsPagination()
+            paginator = get_posts_paginator(request)
             posts = paginator.paginate_queryset(final_queryset, request)
-            for post in posts:
-                # TODO: Difference in source vs origin?
-                post.source = request.scheme + "://" + str(request.META["HTTP_HOST"]) + "/posts/" + str(post.id)
-                post.origin = request.scheme + "://" + str(request.META["HTTP_HOST"]) + "/posts/" + str(post.id)
-                post.published = post.created_on
-                if (post.markdown == False):
-                    post.contentType = "text/plain"
-                else:
-                    post.contentType = "text/x-markdown"
-                post.author.id = post.author.uuid
-                post.author.host = "http://" + request.get_host() + "/api"
-                if len(post.author.github_url) > 0:
-                    post.author.github = "http://" + post.author.github_url
-                else:
-                    post.author.github = post.author.github_url
-
-            posts_serializer = PostsSerializer(posts, many=True)
+            validators = get_posts_validators(request, posts, paginator.get_count())
+            not_modified = get_not_modified(request, validators)
+            if not_modified is not None:
+                return not_modified
             response = {
                 "query" : "posts",
-                "count" : len(final_queryset),
                 "size": get_page_size(request, paginator),
-                "posts" : posts_serializer.data}
+                "posts" : serialize_posts(request, posts)}
+            # Cursor pages don't have a count.
+            if (paginator.get_count() is not None):
+                response['count'] = paginator.get_count()
             # Do not return previous if page is 0.
             if (paginator.get_previous_link() is not None):
                response['previous'] = paginator.get_previous_link()
             # Do not return next if last page
             if (paginator.get_next_link() is not None):
                 response['next'] = paginator.get_next_link()
-            return Response(response)
+            return set_validators(Response(response), validators)
         except Author.DoesNotExist:
             return Response({'Error': 'Author does not exist.'}, status=status.HTTP_404_NOT_FOUND)
 
@@ -140,7 +298,7 @@ class PostsQuery(APIView):
     API endpoint that gets all posts marked as PUBLIC
     GET /api/posts
     """
-    authentication_classes = (BasicAuthentication,)
+    authentication_classes = (NodeBasicAuthentication,)
     permission_classes = (IsAuthenticated,)
     pagination_class = PostsPagination
 
@@ -153,32 +311,20 @@ class PostsQuery(APIView):
         try:
             # author = Author.objects.get(uuid=authorid)
             # friend_uuids = author.get_all_friend_uuids()
-            posts_queryset = Post.objects.filter(visibility="PUBLIC").order_by('-created_on')
-            paginator = PostsPagination()
+            posts_queryset = Post.objects.filter(visibility="PUBLIC").select_related('author').order_by('-created_on')
+            paginator = get_posts_paginator(request)
             posts = paginator.paginate_queryset(posts_queryset, request)
-            for post in posts:
-                # TODO: Difference in source vs origin?
-                post.source = request.scheme + "://" + str(request.META["HTTP_HOST"]) + "/posts/" + str(post.id)
-                post.origin = request.scheme + "://" + str(request.META["HTTP_HOST"]) + "/posts/" + str(post.id)
-                post.published = post.created_on
-                if (post.markdown == False):
-                    post.contentType = "text/plain"
-                else:
-                    post.contentType = "text/x-markdown"
-                post.author.id = post.author.uuid
-                post.author.host = "http://" + request.get_host() + "/api"
-                if len(post.author.github_url) > 0:
-                    post.author.github = "http://" + post.author.github_url
-                else:
-                    post.author.github = post.author.github_url
-
-
-            posts_serializer = PostsSerializer(posts, many=True)
+            validators = get_posts_validators(request, posts, paginator.get_count())
+            not_modified = get_not_modified(request, validators)
+            if not_modified is not None:
+                return not_modified
             response = {
                 "query" : "posts",
-                "count" : len(posts_queryset),
                 "size": get_page_size(request, paginator),
-                "posts" : posts_serializer.data}
+                "posts" : serialize_posts(request, posts)}
+            # Cursor pages don't have a count.
+            if (paginator.get_count() is not None):
+                response['count'] = paginator.get_count()
            # Do not return previous if page is 0.
             if (paginator.get_previous_link() is not None):
                response['previous'] = paginator.get_previous_link()
@@ -187,7 +333,7 @@ class PostsQuery(APIView):
             if (paginator.get_next_link() is not None):
                 response['next'] = paginator.get_next_link()
 
-            return Response(response)
+            return set_validators(Response(response), validators)
         except Author.DoesNotExist:
             return Response({'Error': 'Author does not exist'}, status=status.HTTP_404_NOT_FOUND)
 
@@ -196,7 +342,7 @@ class PostIDQuery(APIView):
     API endpoint that sends a single posts info
     GET /api/posts/<postid>
     """
-    authentication_classes = (BasicAuthentication,)
+    authentication_classes = (NodeBasicAuthentication,)
     permission_classes = (IsAuthenticated,)
     pagination_class = PostsPagination
 
@@ -208,7 +354,7 @@ class PostIDQuery(APIView):
         content = {'user': unicode(request.user), 'auth': unicode(request.auth),}
 
         try:
-            post = Post.objects.filter(id=post_id).first()
+            post = Post.objects.filter(id=post_id).select_related('author').first()
             if (post is None):
                 return Response({'Error': 'Post does not exist'}, status=status.HTTP_404_NOT_FOUND)
 
@@ -220,29 +366,17 @@ class PostIDQuery(APIView):
                 return Response({'Error': 'Forbidden.'}, status=status.HTTP_403_FORBIDDEN)
 
             else:
-                # TODO: Difference in source vs origin?
-                post.source = request.scheme + "://" + str(request.META["HTTP_HOST"]) + "/posts/" + str(post.id)
-                post.origin = request.scheme + "://" + str(request.META["HTTP_HOST"]) + "/posts/" + str(post.id)
-                post.published = post.created_on
-                if (post.markdown == False):
-                    post.contentType = "text/plain"
-                else:
-                    post.contentType = "text/x-markdown"
-                post.author.id = post.author.uuid
-                post.author.host = "http://" + request.get_host() +  "/api"
-                if len(post.author.github_url) > 0:
-                    post.author.github = "http://" + post.author.github_url
-                else:
-                    post.author.github = post.author.github_url
-
-                posts_serializer = PostsSerializer(post)
+                validators = get_posts_validators(request, [post])
+                not_modified = get_not_modified(request, validators)
+                if not_modified is not None:
+                    return not_modified
                 response = {
                     "query" : "posts",
                     "count" : 1,
                     "size": 1,
-                    "posts" : posts_serializer.data}
+                    "posts" : serialize_posts(request, [post])[0]}
 
-                return Response(response)
+                return set_validators(Response(response), validators)
         except Author.DoesNotExist:
             return Response({'Error': 'Author does not exist.'}, status=status.HTTP_404_NOT_FOUND)
 
@@ -250,7 +384,7 @@ class CommentsViewSet(APIView):
     """
     Get all comments for a post
     """
-    authentication_classes = (BasicAuthentication,)
+    authentication_classes = (NodeBasicAuthentication,)
     permission_classes = (IsAuthenticated,)
     pagination_class = PostsPagination
 
@@ -288,6 +422,11 @@ class CommentsViewSet(APIView):
             if (post is None):
                 return Response({'Error': 'Post doest not exist.'}, status=status.HTTP_404_NOT_FOUND)
 
+            validators = get_posts_validators(request, [post])
+            not_modified = get_not_modified(request, validators)
+            if not_modified is not None:
+                return not_modified
+
             local_comments = Comment.objects.filter(parent_post=post).order_by('-created_on')
             remote_comments = ForeignComment.objects.filter(parent_post=post).order_by('-created_on')
             #paginator = PostsPagination()
@@ -328,7 +467,7 @@ class CommentsViewSet(APIView):
             #if (paginator.get_next_link() is not None):
             #    response['next'] = paginator.get_next_link()
 
-            return Response(response)
+            return set_validators(Response(response), validators)
         except Author.DoesNotExist:
             return Response({'Error': 'Author does not exist'}, status=status.HTTP_404_NOT_FOUND)
 
@@ -409,7 +548,7 @@ class IsFriendQuery(APIView):
     GET http://service/friends/<authorid1>/<authorid2>
     where authorid1 and authorid2 are uuids
     """
-    authentication_classes = (BasicAuthentication,)
+    authentication_classes = (NodeBasicAuthentication,)
     permission_classes = (IsAuthenticated,)
     def get(self, request, authorid1, authorid2, format=None):
         content = {'user': unicode(request.user), 'auth': unicode(request.auth),}
@@ -438,11 +577,54 @@ class IsFriendQuery(APIView):
                 return Response({'Error': 'Neither author exists on this server.'}, status=status.HTTP_404_NOT_FOUND)
         return Response({"query": "friends", "authors": [authorid1, authorid2], "friends": is_friends})
 
+class FriendshipsQuery(APIView):
+    """
+    Ask about many pairs of authors at once, instead of calling IsFriendQuery for each.
+    POST http://service/friends/check/
+    {"query": "friendships", "pairs": [[authorid1, authorid2], ...]}
+    At most FRIENDSHIPS_QUERY_MAX_PAIRS pairs per request. Pairs where neither author is
+    ours are answered false.
+    """
+    authentication_classes = (NodeBasicAuthentication,)
+    permission_classes = (IsAuthenticated,)
+    def post(self, request, format=None):
+        serializer = FriendshipsQuerySerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response({'Errors': serializer.errors}, status.HTTP_400_BAD_REQUEST)
+        pairs = serializer.validated_data['pairs']
+        friends = Author.objects.are_friends(pairs)
+        return Response({"query": "friendships", "pairs": [
+            {"authors": pair, "friends": is_friends} for pair, is_friends in zip(pairs, friends)]})
+
+class FriendsDigestQuery(APIView):
+    """
+    A Bloom filter of the author's friends (local and foreign) so other nodes can rule out
+    friends of friends without asking for the whole list, see socknet.friend_digest.
+    GET http://service/friends/<authorid>/digest/
+    """
+    authentication_classes = (NodeBasicAuthentication,)
+    permission_classes = (IsAuthenticated,)
+    def get(self, request, authorid, format=None):
+        try:
+            author = Author.objects.get(uuid=authorid)
+        except Author.DoesNotExist:
+            return Response({'Error': 'The author does not exist.'}, status=status.HTTP_404_NOT_FOUND)
+        digest = FriendDigest.build(author.get_all_friend_uuids(), settings.FRIEND_DIGEST_FALSE_POSITIVE_RATE)
+        validators = (digest.version, None)
+        response = get_not_modified(request, validators)
+        if response is None:
+            content = {"query": "friendsdigest", "author": authorid}
+            content.update(digest.as_dict())
+            response = Response(content)
+        set_validators(response, validators)
+        response['Cache-Control'] = 'max-age=' + str(settings.FRIEND_DIGEST_MAX_AGE)
+        return response
+
 class FriendsQuery(APIView):
     """
     Handles getting an authors friends and checking if anyone in a list is their friend.
     """
-    authentication_classes = (BasicAuthentication,)
+    authentication_classes = (NodeBasicAuthentication,)
     permission_classes = (IsAuthenticated,)
     def get(self, request, authorid, format=None):
         """
@@ -495,7 +677,7 @@ class FriendRequest(APIView):
     Author = The user who is receiving the friend request (local author).
     Friend = The user who is making the friend request (remote author).
     """
-    authentication_classes = (BasicAuthentication,)
+    authentication_classes = (NodeBasicAuthentication,)
     permission_classes = (IsAuthenticated,)
     def post(self, request, format=None):
         content = {'user': unicode(request.user), 'auth': unicode(request.auth),}
@@ -577,7 +759,7 @@ class FriendRequest(APIView):
 
 class ProfileView(APIView):
 
-    authentication_classes = (BasicAuthentication,)
+    authentication_classes = (NodeBasicAuthentication,)
     permission_classes = (IsAuthenticated,)
 
     def get(self, request, authorid, format=None):
@@ -598,17 +780,24 @@ class ViewApiRawImage(APIView):
     """ After authentication verification it opens image as blob and then
     encode it to base64 and put that in the html.
     """
-    authentication_classes = (BasicAuthentication,)
+    authentication_classes = (NodeBasicAuthentication,)
     permission_classes = (IsAuthenticated,)
     def get(self, request, img, format=None):
         """
         Returns a specific image with given image_id.
         GET http://service/api/media/<image_id>
+        GET http://service/api/media/<image_id>?size=thumb for a resized variant (see settings.IMAGE_VARIANTS)
         """
         content = {'user': unicode(request.user), 'auth': unicode(request.auth),}
+        size = request.query_params.get('size')
+        if size and size not in settings.IMAGE_VARIANTS:
+            return Response({'Error': 'Unknown image size, use one of: ' + ', '.join(sorted(settings.IMAGE_VARIANTS))},
+                status=status.HTTP_400_BAD_REQUEST)
         try:
-            img_obj = ImageServ.objects.get(pk=img)
-            base64obj = "data:" + img_obj.imagetype + ";base64," +  base64.b64encode(img_obj.image)
+            img_obj = ImageServ.objects.defer('image').get(pk=img)
+            if size:
+                img_obj = img_obj.get_variant(size)
+            base64obj = "data:" + img_obj.imagetype + ";base64," +  base64.b64encode(img_obj.read_image())
             return Response({"imagedata": base64obj})
         except:
             return Response({'Error': 'An error happened with retrieving the image.'}, status=status.HTTP_404_NOT_FOUND)
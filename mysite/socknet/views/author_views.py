@@ -1,8 +1,8 @@
 import json
 import uuid
 import requests
-from requests.auth import HTTPBasicAuth
 
+from django.conf import settings
 from django.shortcuts import get_object_or_404
 from django.views import generic
 from django.contrib.auth.mixins import LoginRequiredMixin
@@ -16,6 +16,8 @@ from socknet.utils import *
 from socknet.models import *
 from socknet.forms import *
 from socknet.serializers import ProfileSerializer,PostsSerializer
+from socknet.node_client import NodeClient
+from socknet.federation import iter_node_posts
 
 class ViewProfile(LoginRequiredMixin, generic.base.TemplateView):
     """ Displays an Authors profile """
@@ -168,10 +170,8 @@ class ManageFriends(LoginRequiredMixin, generic.base.TemplateView):
         # Get all friend of a user.
         context = super(ManageFriends, self).get_context_data(**kwargs)
 
-        # Check pending friend requests incase someone accepted!
+        # Friend requests accepted on other nodes are picked up by the reconcile_foreign_friends command.
         profile_author = self.request.user.author
-        for foreign_author in profile_author.foreign_friends_im_following.all():
-            update_friend_status(profile_author, foreign_author)
         friends = profile_author.get_friends()
         context['friends'] = friends
         context['count'] = len(friends)
@@ -306,37 +306,57 @@ class ViewRemoteProfile(LoginRequiredMixin, generic.base.TemplateView):
         authorUUID = self.kwargs.get('authorUUID', self.request.user.author.uuid)
         nodeId = self.kwargs.get('nodeID')
         node = get_object_or_404(Node, id=nodeId)
+        client = NodeClient(node)
+        print "Node url: " + client.base_url
+
+        """
+        Ask for the remote author, their posts and whether we are a FOAF all at once,
+        they don't depend on each other so the page waits for the slowest instead of the sum.
+        """
+        is_friend = self.request.user.author.is_friend(authorUUID)
+        calls = {
+            'profile': lambda: client.get('author/' + authorUUID, cache='author'),
+            'posts': lambda: list(iter_node_posts(node, 'author/' + authorUUID + '/posts', cache='author_posts',
+                max_posts=settings.NODE_FEED_VIEW_MAX_POSTS)),
+        }
+        if not is_friend:
+            # Friends can see FOAF posts anyway
+            remote_author = ForeignAuthor.objects.filter(id=authorUUID).first() or ForeignAuthor(id=uuid.UUID(authorUUID), node=node)
+            calls['foaf'] = lambda: is_FOAF_remote(self.request.user.author, remote_author)
+        results, failures = call_concurrently(lambda name: calls[name](), calls.keys(), settings.NODE_FETCH_DEADLINE)
+        results = dict(results)
+        failures = dict(failures)
+        for name, reason in failures.items():
+            print "View Remote Profile Error: " + name + " call failed: " + reason + " from " + node.name
 
         """
         Get the remote author
         """
-        url = node.url
-        if url[-1] is not "/":
-            url = url + "/"
-        print "Node url: " + url
-        response = requests.get(url + 'author/' + authorUUID , auth=HTTPBasicAuth(node.foreignNodeUser, node.foreignNodePass))
-        #print(response.text)
-
-        # Ensure we got a 200
-        if response.status_code is not 200:
-            e = "View Remote Profile Error: Response code was " + str(response.status_code) + " from " + node.name
-            context['error'] = e
-            print e
-
-        # Ensure we got data back
-        if (len(response.text) < 1):
-            e = "View Remote Profile Error: No JSON was sent back. From " + node.name
-            context['error'] = e
-            print e
-
-        # Parse the json
         json_data = None
-        try:
-            json_data = json.loads(response.text)
-        except ValueError, error:
-            context['error'] = "Error: " + str(error)
-            print "View Remote Profile Error: " + str(error) + " from " + node.name
+        response = results.get('profile')
+        if response is None:
+            context['error'] = "Could not reach " + node.name + ": " + failures['profile']
+        else:
+            # Ensure we got a 200
+            if response.status_code is not 200:
+                e = "View Remote Profile Error: Response code was " + str(response.status_code) + " from " + node.name
+                context['error'] = e
+                print e
+
+            # Ensure we got data back
+            if (len(response.text) < 1):
+                e = "View Remote Profile Error: No JSON was sent back. From " + node.name
+                context['error'] = e
+                print e
+
+            # Parse the json
+            try:
+                json_data = json.loads(response.text)
+            except ValueError, error:
+                context['error'] = "Error: " + str(error)
+                print "View Remote Profile Error: " + str(error) + " from " + node.name
 
+        is_FOAF = is_friend
         if json_data: # Only do stuff if we actually have data
             serializer = ProfileSerializer(data=json_data)
             # Ensure the data is valid
@@ -371,36 +391,33 @@ class ViewRemoteProfile(LoginRequiredMixin, generic.base.TemplateView):
                     context['error'] = "Key Error: " + str(error)
                     print "View Remote Profile Key Error: " + str(error) + " from " + node.name
 
-            is_FOAF = False
-            is_friend = False
             if foreign_author: # Only do stuff if we actually have an object.
                 context['profile_author'] = foreign_author
-                update_friend_status(self.request.user.author, foreign_author) # Update friends relati
-                is_friend = self.request.user.author.is_friend(foreign_author.id)
                 if is_friend:
-                    is_FOAF = True
                     context["friend_status"] = "FRIEND"
+                elif foreign_author in self.request.user.author.foreign_friends_im_following.all():
+                    context["friend_status"] = "PENDING"
                 else:
-                    is_FOAF = is_FOAF_remote(self.request.user.author, foreign_author)
-                    if foreign_author in self.request.user.author.foreign_friends_im_following.all():
-                        context["friend_status"] = "PENDING"
-                    else:
-                        context["friend_status"] = "NONE"
-                print("Is FOAF? " + str(is_FOAF))
+                    context["friend_status"] = "NONE"
+
+        if not is_friend:
+            if 'foaf' in results:
+                is_FOAF = results['foaf']
+            else:
+                # Without an answer only show what everyone can see
+                context['foaf_unknown'] = True
+        print("Is FOAF? " + str(is_FOAF))
 
         """
         Get the remote author's posts
         """
         posts = []
-        r = requests.get(url + 'author/' + authorUUID  + '/posts', auth=HTTPBasicAuth(node.foreignNodeUser, node.foreignNodePass))
-        if (len(r.text) > 0):
-            data = {}
-            try:
-                data = json.loads(r.text)
-            except Exception as e:
-                print("View Remote Profile Fetch Posts Error: " + str(e) + " from " + node.name)
+        posts_json = results.get('posts')
+        if posts_json is None:
+            context['posts_error'] = "Could not load posts from " + node.name + ": " + failures['posts']
+        else:
             try:
-                for post_json in data['posts']:
+                for post_json in posts_json:
                     posts_serializer = PostsSerializer(data=post_json)
                     valid = posts_serializer.is_valid()
                     if not valid:
@@ -449,9 +466,6 @@ class ViewRemoteProfile(LoginRequiredMixin, generic.base.TemplateView):
                 authorUUID = uuid.UUID(authorUUID)
                 foreign_author = get_object_or_404(ForeignAuthor, id=authorUUID)
                 local_author = self.request.user.author
-                url = node.url
-                if url[-1] is not "/":
-                    url = url + "/"
                 data = {
                     "query": "friendrequest",
                     "author": {
@@ -468,7 +482,7 @@ class ViewRemoteProfile(LoginRequiredMixin, generic.base.TemplateView):
                     }
                 }
                 json_data = json.dumps(data) # encode
-                response = requests.post(url=url + "friendrequest/", headers={"content-type": "application/json"}, data=json_data, auth=HTTPBasicAuth(node.foreignNodeUser, node.foreignNodePass))
+                response = NodeClient(node).post("friendrequest/", headers={"content-type": "application/json"}, data=json_data)
                 print("RESPONSE FROM SENDING FRIEND REQUEST")
                 print(response.status_code)
                 print(response)
@@ -2,27 +2,34 @@ import uuid
 import json
 import datetime
 import urllib
+from itertools import izip_longest
 from django.shortcuts import get_object_or_404, redirect
 from django.views import generic
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
-from django.http import HttpResponse, FileResponse
+from django.http import HttpResponse, FileResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
 from django.views.generic.edit import DeleteView
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+from django.db.models import Q
+from django.utils import timezone
 
 from socknet.models import *
 from socknet.forms import *
 from socknet.serializers import *
 from socknet.utils import *
+from socknet.federation import iter_node_posts, refresh_foreign_post
 
 
 # For images
 import os
 from mysite.settings import MEDIA_ROOT
+from django.conf import settings
 from PIL import Image, ImageFile
 import base64
 
 import requests
-from requests.auth import HTTPBasicAuth
+from socknet.node_client import NodeClient
 
 
 class ListPosts(LoginRequiredMixin, UserPassesTestMixin, generic.ListView):
@@ -42,55 +49,20 @@ class ListPosts(LoginRequiredMixin, UserPassesTestMixin, generic.ListView):
             return True
 
 class ListRemotePosts(LoginRequiredMixin, UserPassesTestMixin, generic.ListView):
-    """ Displays a list of all posts in the system """
+    """ Displays the posts of the other nodes, copied here by the sync_remote_posts command """
     template_name = 'socknet/post_templates/list_remote_posts.html'
     login_url = '/login/' # For login mixin
     context_object_name = 'posts_list'
+    paginate_by = 10
 
     def get_queryset(self):
-        posts = []
-        for n in Node.objects.all():
-            print "\nFetching Post Lists data from Node: " + n.name
-            url = n.url
-            # In case entered like host.com/api instead of host.com/api/
-            url = HTMLsafe.get_url_fixed(n.url)
-            # In case entered like host.com/api instead of host.com/api/
-            print url
-            r = requests.get(url + 'posts', auth=HTTPBasicAuth(n.foreignNodeUser, n.foreignNodePass))
-
-            if r.status_code is not 200:
-                print("Error response code was bad: " + str(r.status_code) + " from: " + n.name)
-            elif (len(r.text) < 1):
-                print("Response was empty from: " + n.name)
-            else:
-                data = {}
-                try:
-                    # Parse the json
-                    data = json.loads(r.text)
-                    try:
-                        for post_json in data['posts']:
-                            serializer = PostsSerializer(data=post_json)
-                            valid = serializer.is_valid()
-                            if not valid:
-                                # Ignore posts that are not valid
-                                print("Error from group: " + n.name + ", serializer is not valid.")
-                                print(serializer.errors)
-                            else:
-                                post_data = serializer.validated_data
-                                post_author = post_data['author']
-
-                                post = RemotePost(post_json['id'], post_data['title'], post_data['description'], post_data['contentType'],
-                                    post_data['content'], post_data['visibility'], post_data['published'], post_author['displayName'], post_author['id'],n)
-                                posts.append(post)
-                    except Exception as e:
-                        print("Error from group: " + n.name + "while parsing post data")
-                        print(str(e))
-                except Exception as e:
-                    print("Error from group: " + n.name + "after calling json.loads:")
-                    print(str(e))
-        if len(posts) > 0:
-            return sorted(posts, reverse=True, key=lambda RemotePost: RemotePost.published)
-        return posts
+        return ForeignPost.objects.filter(listed=True).select_related('node').order_by('-published', '-id')
+
+    def get_context_data(self, **kwargs):
+        context = super(ListRemotePosts, self).get_context_data(**kwargs)
+        # Nodes that are down or whose last sync failed, their posts may be out of date.
+        context['skipped_nodes'] = Node.objects.filter(~Q(posts_sync_error='') | Q(circuit_open_until__gt=timezone.now()))
+        return context
 
     def test_func(self):
         try:
@@ -106,72 +78,75 @@ class ListFriendsPosts(LoginRequiredMixin, UserPassesTestMixin, generic.ListView
     context_object_name = 'posts_list'
 
     def get_queryset(self):
-        posts_list = []
         author = self.request.user.author
 
-        # Get all of the authors friends
-        local_friends = author.friends.all()
-        remote_friends = author.foreign_friends.all()
-
-        if len(local_friends) > 0:
-            for friend in local_friends:
-                # We want posts marked PUBLIC, FRIENDS, FOAF, SERVERONLY
-                # Since we are their friend, we should be allowed to see FOAF posts
-                local_posts = Post.objects.filter(author=friend).exclude(visibility="PRIVATE")
-                # Convert posts to PostDetail object
-                for post in local_posts:
-                    posts_list.append(PostDetails(post, True))
-
-        if len(remote_friends) > 0:
-            for friend in remote_friends:
-                print("Attempting to get posts from " + friend.display_name + " from " + friend.node.name)
-                # Get our friends posts
-                url = friend.node.url
-                if url[-1] is not "/":
-                    url = url + "/"
-                # Send the request to the other server
-                url = url + "author/" + str(friend.id) + "/posts"
-                print(url)
-                response = None
-                try:
-                    response = requests.get(url=url, auth=HTTPBasicAuth(friend.node.foreignNodeUser, friend.node.foreignNodePass), timeout=5) # TIME OUT AFTER 5 SEC
-                    # Ensure we got a 200
-                except requests.exceptions.Timeout as e:
-                    print("The request timed out for " + friend.display_name + " from " + friend.node.name)
-
-                if response.status_code is not 200:
-                    error = "Error: Response code was " + str(response.status_code) + " for " + friend.display_name + " from " + friend.node.name
-                    print error
-                # Ensure we got data back
-                elif (len(response.text) < 0):
-                    error = "Error: No JSON was sent back for " + friend.display_name + " from " + friend.node.name
-                    print error
-                else:
-                    # At this point, we got a 200 and some data
-                    try:
-                        data = json.loads(response.text)
-                        # Loop through the posts
-                        for post_json in data['posts']:
-                            serializer = PostsSerializer(data=post_json)
-                            if not serializer.is_valid():
-                                print("Error: Post is not valid from " + friend.display_name + " from " + friend.node.name + " reason:")
-                                print(serializer.errors)
-                            else:
-                                post_uuid = uuid.UUID(post_json['id']) # If uuid is not valid, an error will be thrown
-                                # If the post json is valid, create a post details object.
-                                # Note: PostDetails will throw a key error if an essiential item is missing, such as title or content
-                                post = PostDetails(serializer.validated_data, False, friend.node, post_uuid)
-                                # Only display the post if it is PUBLIC, FOAF, or FRIENDS
-                                if post.visibility == "PUBLIC" or post.visibility == "FOAF" or post.visibility == "FRIENDS":
-                                    posts_list.append(post)
-                    except Exception as e:
-                        error = "Error: " + str(e) + " for " + friend.display_name + " from " + friend.node.name
-                        print error
+        # We want posts marked PUBLIC, FRIENDS, FOAF, SERVERONLY
+        # Since we are their friend, we should be allowed to see FOAF posts
+        local_posts = Post.objects.filter(author__in=author.friends.all()).exclude(visibility="PRIVATE").select_related('author')
+        # Convert posts to PostDetail object
+        posts_list = [PostDetails(post, True) for post in local_posts]
+
+        # Group the remote friends by node, the friends of a node share its Node object
+        # so once a request to it fails the others see it (and its circuit) right away.
+        nodes = {}
+        friends_by_node = {}
+        for friend in author.foreign_friends.select_related('node'):
+            friend.node = nodes.setdefault(friend.node_id, friend.node)
+            friends_by_node.setdefault(friend.node_id, []).append(friend)
+        # Take a friend from each node in turn so one node can't hold every worker.
+        remote_friends = [friend for friends in izip_longest(*friends_by_node.values()) for friend in friends if friend is not None]
+
+        # Nodes that are down are only tried once per page, and not at all while their circuit is open.
+        self.unavailable_nodes = set()
+        results, failures = call_concurrently(self.fetch_friend_posts, remote_friends, settings.NODE_FETCH_DEADLINE)
+        for friend, posts in results:
+            posts_list.extend(posts)
+        for friend, reason in failures:
+            print("Could not get posts of " + friend.display_name + " from " + friend.node.name + ": " + reason)
+            self.unavailable_nodes.add(friend.node.name)
 
         if len(posts_list) > 0:
             return sorted(posts_list, reverse=True, key=lambda PostDetails: PostDetails.published)
         return posts_list
 
+    def fetch_friend_posts(self, friend):
+        """
+        Gets the posts a remote friend shares with us, runs on a worker thread.
+        Only raises when the node couldn't be reached, bad answers are printed and give no posts.
+        """
+        if friend.node.name in self.unavailable_nodes or not friend.node.is_available():
+            self.unavailable_nodes.add(friend.node.name)
+            return []
+        print("Attempting to get posts from " + friend.display_name + " from " + friend.node.name)
+        posts_list = []
+        # Get our friends posts, they are read one at a time as the node sends them
+        try:
+            for post_json in iter_node_posts(friend.node, "author/" + str(friend.id) + "/posts", max_posts=settings.NODE_FEED_VIEW_MAX_POSTS):
+                serializer = PostsSerializer(data=post_json)
+                if not serializer.is_valid():
+                    print("Error: Post is not valid from " + friend.display_name + " from " + friend.node.name + " reason:")
+                    print(serializer.errors)
+                else:
+                    post_uuid = uuid.UUID(post_json['id']) # If uuid is not valid, an error will be thrown
+                    # If the post json is valid, create a post details object.
+                    # Note: PostDetails will throw a key error if an essiential item is missing, such as title or content
+                    post = PostDetails(serializer.validated_data, False, friend.node, post_uuid)
+                    # Only display the post if it is PUBLIC, FOAF, or FRIENDS
+                    if post.visibility == "PUBLIC" or post.visibility == "FOAF" or post.visibility == "FRIENDS":
+                        posts_list.append(post)
+        except requests.exceptions.RequestException as e:
+            self.unavailable_nodes.add(friend.node.name)
+            raise
+        except Exception as e:
+            error = "Error: " + str(e) + " for " + friend.display_name + " from " + friend.node.name
+            print error
+        return posts_list
+
+    def get_context_data(self, **kwargs):
+        context = super(ListFriendsPosts, self).get_context_data(**kwargs)
+        context['unavailable_nodes'] = sorted(self.unavailable_nodes)
+        return context
+
     def test_func(self):
         try:
             self.request.user.author
@@ -220,59 +195,21 @@ class ViewRemotePost(LoginRequiredMixin, generic.base.TemplateView):
         context = super(ViewRemotePost, self).get_context_data(**kwargs)
         n = get_object_or_404(Node, id=self.kwargs['nodeID'])
         pid = self.kwargs['pk']
-        comments = []
-        post_original = None
-
-        print "Fetching Post & Comment data from Node: " + n.name
-        url = HTMLsafe.get_url_fixed(n.url)
-        # In case entered like host.com/api instead of host.com/api/
-        print "API URL: " + url
-        rpost = requests.get(url + 'posts/' + str(pid), auth=HTTPBasicAuth(n.foreignNodeUser, n.foreignNodePass))
-        print "Response received"
-        print "post status code:" + str(rpost.status_code)
-
-        # Ensure we got a 200
-        if rpost.status_code is not 200:
-            err = "Error: Response code of url/posts/{id} was " + str(r.status_code)
-            context['error'] = err
-            print err
-
-        # Ensure we got data back
-        if (len(rpost.text) < 0):
-            err = "Error: No JSON from url/posts/{id} was sent back."
-            context['error'] = err
-            print err
-
-        datafind = {}
-        postfind = None
-        try:
-            postfind = json.loads(rpost.text)
-            #datafind = json.loads(r.text)
-        except ValueError, error:
-            context['error'] = "Error: " + str(error)
-            print("ValueError json loads in post_views.py ViewRemotePost" + str(error))
 
-        try:
-            if postfind is not None :
-                postdat = postfind['posts']
-                print(postdat)
-                post_original = RemotePost(postdat['id'], postdat['title'], postdat['description'], postdat['contentType'],
-                            postdat['content'], postdat['visibility'], postdat['published'], postdat['author']['displayName'], postdat['author']['id'],n)
-                datafind = postdat['comments']
-                for i in datafind:
-                    if "contentType" not in i:
-                        i['contentType'] = text/x-markdown
-                    print("\n")
-                    print(i)
-                    dat = RemoteComment(i['id'], i['contentType'], i['comment'], i['published'], i['author']['displayName'], i['author']['id'], i['author']['host'], n)
-                    comments.append(dat)
-        except KeyError, error:
-            context['error'] = "Error: comments KeyError, " + str(error)
-            print("KeyError json loads for comments in post_views.py ViewRemotePost" + str(error))
+        post_original = ForeignPost.objects.select_related('node').filter(node=n, post_id=pid).first()
+        if post_original is None:
+            # Not synced yet, or not in the node's post list. Ask the node for it.
+            try:
+                post_original = refresh_foreign_post(n, pid, cache='post')
+            except Exception as error:
+                context['error'] = "Error: " + str(error)
+                print("Could not fetch post " + pid + " from " + n.name + ": " + str(error))
 
-        try:
+        comments = []
+        if post_original is not None:
+            comments = post_original.get_comments()
             context['post_auth_id'] = post_original.author_id
-        except AttributeError, error:
+        else:
             context['post_auth_id'] = None
         context['postdat'] = post_original
         context['num_comments'] = len(comments)
@@ -318,9 +255,12 @@ class CreatePost(LoginRequiredMixin, generic.edit.CreateView):
             image_dat = upload_obj.read()
             imagetype = upload_obj.content_type
             img = ImageServ.objects.create_image(image_dat, self.request.user.author, form.instance, imagetype)
+            # Resize now so the first people viewing the post don't wait for it.
+            img.create_variants()
             # Update field of the created post with the image path.
             form.instance.imglink = img.id
-            link_str = "http://" + self.request.get_host() + "/media/" + str(img.id)
+            # Link the display size so pages and other nodes don't pull the original.
+            link_str = "http://" + self.request.get_host() + "/media/" + str(img.id) + "?size=display"
             # If post already close to 512 max char, link may be cut or even not be there...
             if form.instance.markdown:
                 form.instance.content = form.instance.content + "\n![Attached Image](" + link_str + ")"
@@ -460,7 +400,7 @@ class CreateForeignComment(LoginRequiredMixin, generic.base.TemplateView):
         head = {
             "content-type" : "application/json"
         }
-        req = requests.post(url_post + '/comments/', auth=HTTPBasicAuth(node_obj.foreignNodeUser, node_obj.foreignNodePass), data=json.dumps(add), headers=head)
+        req = NodeClient(node_obj).post("posts/" + self.kwargs.get('pk') + "/comments/", data=json.dumps(add), headers=head)
         #print add
         print "\n\n-----------------CREATING A FOREIGN COMMENT"
         print "Received status code:" + str(req.status_code)
@@ -471,6 +411,12 @@ class CreateForeignComment(LoginRequiredMixin, generic.base.TemplateView):
         #print str(req.text)
         # content_type="application/json"
         #nodeID>[0-9]+)/remote_posts/(?P<pk
+        if 200 <= req.status_code < 300:
+            # Update our copy of the post so the new comment shows up.
+            try:
+                refresh_foreign_post(node_obj, self.kwargs.get('pk'))
+            except Exception as error:
+                print("Could not refresh post after commenting: " + str(error))
         r = HttpResponse(status=200)
         r.write(url_post + "<br>" + str(add) + "<br> received status code: " + str(req.status_code) + "<br>" + str(req.text))
         #return r
@@ -484,23 +430,102 @@ class ViewImage(LoginRequiredMixin, generic.base.TemplateView):
     def get_context_data(self, **kwargs):
         context = super(ViewImage, self).get_context_data(**kwargs)
         parent_key = self.kwargs.get('img')
-        imgobj = ImageServ.objects.get(pk=parent_key)
+        imgobj = ImageServ.objects.defer('image').get(pk=parent_key)
         context['image_usr'] = imgobj.author.displayName
         context['image_made'] = imgobj.created_on
         context['image_id'] = imgobj.id
-        context['b64'] = "data:" + imgobj.imagetype + ";base64," +  base64.b64encode(imgobj.image)
+        context['b64'] = "data:" + imgobj.imagetype + ";base64," +  base64.b64encode(imgobj.read_image())
         return context
 
+# Images never change once uploaded, let browsers and proxies keep them for a year.
+IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+IMAGE_CHUNK_SIZE = 64 * 1024
+
+def parse_byte_range(header, size):
+    """
+    Parses a Range header for a single range of bytes, returns the (first, last) byte positions.
+    Returns None when the header should be ignored and the whole image sent (missing,
+    malformed or asking for several ranges). Raises ValueError when the range can't be satisfied.
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, sep, last = header[len("bytes="):].strip().partition("-")
+    if not sep or not (first.isdigit() or last.isdigit()):
+        return None
+    if not first:
+        # bytes=-n is the last n bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError("Empty suffix range")
+        return max(size - length, 0), size - 1
+    first = int(first)
+    if last and not last.isdigit():
+        return None
+    if last and int(last) < first:
+        return None
+    if first >= size:
+        raise ValueError("Range starts after the end of the image")
+    last = int(last) if last else size - 1
+    return first, min(last, size - 1)
+
+def read_chunks(image_file, first, last):
+    """ Yields the bytes from first to last (inclusive) in chunks, then closes the file. """
+    try:
+        image_file.seek(first)
+        remaining = last - first + 1
+        while remaining > 0:
+            chunk = image_file.read(min(IMAGE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        image_file.close()
+
 """
-No authentication, it opens image as blob and then
-encode it to base64 and put that in the html.
+No authentication, streams the image bytes from the image storage.
+?size=<name> serves a resized variant (see settings.IMAGE_VARIANTS) instead of the original.
+Supports conditional requests (ETag) and single byte ranges.
 """
 def raw_image_serve(request, img):
-    imgobj = ImageServ.objects.get(pk=img)
-    imgdat = imgobj.image
-    #return FileResponse(imgobj.image)
-    r = HttpResponse()
+    # Don't load the legacy blob column unless the image hasn't been moved out yet.
+    imgobj = ImageServ.objects.defer('image').get(pk=img)
+    size = request.GET.get("size")
+    if size:
+        if size not in settings.IMAGE_VARIANTS:
+            return HttpResponse("Unknown image size, use one of: " + ", ".join(sorted(settings.IMAGE_VARIANTS)), status=400)
+        imgobj = imgobj.get_variant(size)
+    # The digest identifies the bytes, images that were never moved to the storage keep the same bytes for their id.
+    etag = imgobj.image_hash or str(imgobj.pk)
+
+    not_modified = get_conditional_response(request, etag=etag)
+    if not_modified is not None:
+        not_modified["ETag"] = quote_etag(etag)
+        not_modified["Cache-Control"] = IMAGE_CACHE_CONTROL
+        return not_modified
+
+    length = imgobj.image_size()
+    byte_range = None
+    # If-Range: only send the range if the client still has this version
+    if_range = request.META.get("HTTP_IF_RANGE")
+    if not if_range or if_range == quote_etag(etag):
+        try:
+            byte_range = parse_byte_range(request.META.get("HTTP_RANGE"), length)
+        except ValueError:
+            r = HttpResponse(status=416)
+            r["Content-Range"] = "bytes */%d" % length
+            return r
+
+    if byte_range is None:
+        r = FileResponse(read_chunks(imgobj.open_image(), 0, length - 1))
+        r["Content-Length"] = length
+    else:
+        first, last = byte_range
+        r = StreamingHttpResponse(read_chunks(imgobj.open_image(), first, last), status=206)
+        r["Content-Range"] = "bytes %d-%d/%d" % (first, last, length)
+        r["Content-Length"] = last - first + 1
     r["Content-Type"] = imgobj.imagetype
-    r["Content-Length"] = len(imgdat)
-    r.write(imgdat)
+    r["Accept-Ranges"] = "bytes"
+    r["ETag"] = quote_etag(etag)
+    r["Cache-Control"] = IMAGE_CACHE_CONTROL
     return r